@@ -21,6 +21,7 @@
 
 __all__ = (
     'fnv1',
+    'fnv1_bulk',
 )
 
 from collections import namedtuple
@@ -50,3 +51,9 @@ def fnv1(bstr, bits):
     32 and 64-bit hashes are supported
     """
     return _fnv1(bstr, _fnv_params[bits])
+
+def fnv1_bulk(bstrs, bits):
+    """Return a dict mapping each distinct string in bstrs to its
+    bits-bit hash. Each distinct string is only hashed once."""
+    params = _fnv_params[bits]
+    return {bstr: _fnv1(bstr, params) for bstr in set(bstrs)}
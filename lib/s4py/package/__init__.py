@@ -4,11 +4,15 @@ from collections import namedtuple
 import os.path
 
 from .. import utils
-from .metapackage import MetaPackage
+from .metapackage import MetaPackage, Conflict
+from .contentcache import ContentCache, set_default_cache
 from .dbpf import DbpfPackage
 from .dirpackage import DirPackage
 
-def open_package(filename, mode="r"):
+def open_package(filename, mode="r", use_mmap=False, **kwargs):
+    """Open a package of any supported format. Additional keyword
+    arguments are passed through to the package constructor when
+    creating a new package."""
     absname = os.path.abspath(filename)
     import sys
     if mode == "r":
@@ -20,7 +24,7 @@ def open_package(filename, mode="r"):
         with open(filename, "rb") as f:
             magic = f.read(4)
             if magic == b"DBPF":
-                return DbpfPackage(filename)
+                return DbpfPackage(filename, use_mmap=use_mmap)
         if filename.lower().endswith(".meta"):
             # It's a metapackage...
             try:
@@ -28,8 +32,14 @@ def open_package(filename, mode="r"):
             except UnicodeError:
                 raise utils.FormatException("Invalid unicode in metapackage")
         raise utils.FormatException("Couldn't identify package format")
+    elif mode in ('a', 'r+'):
+        # Only DBPF files can be updated in place; a dirpackage can
+        # simply be opened for writing.
+        if os.path.isdir(filename):
+            return DirPackage(absname, mode="w", **kwargs)
+        return DbpfPackage(filename, mode, **kwargs)
     elif mode == 'w':
         if filename.endswith(".package"):
-            return DbpfPackage(filename, "w")
+            return DbpfPackage(filename, "w", **kwargs)
         elif filename.endswith("/") or os.path.isdir(filename):
-            return DirPackage(filename, mode="w")
+            return DirPackage(filename, mode="w", **kwargs)
@@ -1,8 +1,19 @@
 import abc
+import io
+from . import contentcache
+from . import index
 from .. import resource
+from .. import stbl
 
 class AbstractPackage(metaclass=abc.ABCMeta):
 
+    # A contentcache.ContentCache for this package's content, or None
+    # to use the default cache (if any)
+    content_cache = None
+
+    # Not every subclass calls __init__
+    __stbl_cache = None
+
     def __init__(self):
         self.__stbl_cache = None
 
@@ -17,6 +28,42 @@ class AbstractPackage(metaclass=abc.ABCMeta):
 
         """
 
+    def _content_cache(self):
+        if self.content_cache is not None:
+            return self.content_cache
+        return contentcache.default_cache()
+
+    def get_content(self, resource):
+        """Return the content of Resource, from the content cache if
+        possible"""
+        cache = self._content_cache()
+        if cache is None:
+            return self._get_content(resource)
+        return cache.get(resource, self._get_content)
+
+    def _uncache(self, rid):
+        """Drop any cached content for rid. Packages that replace
+        resources without changing their locators must call this."""
+        cache = self._content_cache()
+        if cache is not None and rid in self:
+            cache.discard(self[rid])
+
+    def open_content(self, resource):
+        """Return a file object for the content of Resource. Content
+        that's already cached is served from memory."""
+        cache = self._content_cache()
+        if cache is not None:
+            content = cache.lookup(resource)
+            if content is not None:
+                return io.BytesIO(content)
+        return self._open_content(resource)
+
+    def _open_content(self, resource):
+        """Return a file object for the content of Resource. By default,
+        this just wraps _get_content; packages that can stream content
+        should override it."""
+        return io.BytesIO(self._get_content(resource))
+
     @abc.abstractmethod
     def __getitem__(self, item):
         """Maps from a ResourceID to a Resource. Any other usage is an error.
@@ -26,6 +73,19 @@ class AbstractPackage(metaclass=abc.ABCMeta):
 
         """
 
+    def __contains__(self, rid):
+        try:
+            self[rid]
+        except KeyError:
+            return False
+        return True
+
+    def _index_keys(self):
+        """Return an iterable of the packed keys (see index.pack_rid) of
+        every resource in the package. Packages that keep a
+        ResourceIndex should return its keys directly."""
+        return map(index.pack_rid, self.scan_index())
+
     def flush_index_cache(self):
         """Flush the index cache to save memory. This method is optional; some
         database formats may not need an index cache due to use of an
@@ -37,7 +97,7 @@ class AbstractPackage(metaclass=abc.ABCMeta):
             self.__stbl_cache = {}
             for stblid in self.scan_index(
                     resource.ResourceFilter(type=0x220557DA)):
-                for key, value in stbl.read_stbl(self[stblid]):
+                for key, value in stbl.read_stbl(self[stblid].content):
                     self.__stbl_cache[key] = value
         return self.__stbl_cache
 
@@ -0,0 +1,111 @@
+# A bounded LRU cache of decompressed resource content.
+#
+# Inspectors, the stbl property, and SimData cross-references tend to
+# read the same resources over and over, and every Resource.content
+# decompresses from scratch. A ContentCache remembers the most
+# recently used content, up to a limit in bytes. Each package can have
+# its own cache (set its content_cache attribute), and packages that
+# don't fall back to the global one set with set_default_cache.
+
+import collections
+import threading
+
+CacheStats = collections.namedtuple(
+    "CacheStats", "hits misses evictions entries size max_bytes")
+
+class ContentCache:
+    """An LRU cache of resource content, holding at most max_bytes
+    bytes. Content bigger than that is never cached."""
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def _key(resource):
+        # In a DBPF package, the locator changes whenever the copy of a
+        # resource does, so stale entries are never hit; they just age
+        # out. Packages whose locators stay the same (a DirPackage's is
+        # just the file name) discard the entry when they replace a
+        # resource.
+        return (resource.package, resource.id, resource.locator)
+
+    def lookup(self, resource):
+        """Return the cached content for resource, or None"""
+        key = self._key(resource)
+        with self._lock:
+            content = self._entries.get(key)
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return content
+
+    def store(self, resource, content):
+        """Remember content for resource, evicting the least recently
+        used entries to make room"""
+        size = len(content)
+        if size > self.max_bytes:
+            return
+        key = self._key(resource)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = content
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def get(self, resource, load):
+        """Return the content of resource, calling load(resource) to
+        read it if it isn't cached"""
+        content = self.lookup(resource)
+        if content is None:
+            content = load(resource)
+            # Memoryviews into a mapped package cost nothing to
+            # recreate, and holding on to them would keep the package
+            # from being closed.
+            if content is not None and not isinstance(content, memoryview):
+                self.store(resource, content)
+        return content
+
+    def discard(self, resource):
+        """Forget the cached content for resource, if there is any"""
+        with self._lock:
+            content = self._entries.pop(self._key(resource), None)
+            if content is not None:
+                self._size -= len(content)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return CacheStats(self.hits, self.misses, self.evictions,
+                              len(self._entries), self._size,
+                              self.max_bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+_default_cache = None
+
+def set_default_cache(cache):
+    """Use cache (a ContentCache, or None to disable caching) for every
+    package that doesn't have a cache of its own. Returns the previous
+    default."""
+    global _default_cache
+    old, _default_cache = _default_cache, cache
+    return old
+
+def default_cache():
+    return _default_cache
@@ -1,20 +1,136 @@
+import collections
+import concurrent.futures
+import hashlib
 import io
+import itertools
+import mmap
+import os
+import shutil
 from collections import namedtuple
+import struct
+import tempfile
 import zlib
 
 from .abstractpackage import AbstractPackage
+from . import index
 from .. import resource
 from .. import utils
 
+_CONST_TYPE = 1
+_CONST_GROUP = 2
+_CONST_INSTANCE_EX = 4
+
+_uint32 = struct.Struct("<I")
+
+# Compression types, as found in the first half of
+# DbpfLocator.compression
+COMPRESSION_NONE = 0x0000
+COMPRESSION_ZLIB = 0x5A42
+COMPRESSION_DELETED = 0xFFE0
+COMPRESSION_STREAMABLE = 0xFFFE
+COMPRESSION_REFPACK = 0xFFFF
+
+# Streamed resources are read, decompressed, and written in pieces of
+# about this size
+STREAM_CHUNK = 1 << 16
+
+# DbpfPackage.put_stream only streams resources at least this big.
+# Smaller ones are read into memory and stored with put(), which can
+# compress them in the worker pool.
+STREAM_MIN_SIZE = 1 << 24
+
+# How far back a RefPack back-reference can reach
+_REFPACK_WINDOW = 1 << 17
+
 class DbpfLocator(namedtuple("DbpfLocator", 'offset raw_len compression')):
     @property
     def deleted(self):
-        return self.compression[0] == 0xFFE0
+        return self.compression[0] == COMPRESSION_DELETED
+
+class DbpfIndex(index.ResourceIndex):
+    _columns = (('offset', 'I'),
+                ('raw_len', 'I'),
+                ('size', 'I'),
+                ('compression_type', 'H'),
+                ('compression_committed', 'H'))
+
+    def locator(self, row):
+        return DbpfLocator(self.offset[row], self.raw_len[row],
+                           (self.compression_type[row],
+                            self.compression_committed[row]))
+
+    def __init__(self):
+        super().__init__()
+        # Packed key -> row, for each tombstone
+        self._tombstones = {}
+
+    def put(self, rid, *values):
+        key = index.pack_rid(rid)
+        row = self._tombstones.pop(key, None)
+        if row is not None:
+            # Bring the tombstone back to life rather than indexing the
+            # resource twice
+            self._rows[key] = row
+            self._secondary = None
+        return super().put(rid, *values)
+
+    def remove(self, rid, tombstone=True):
+        """Remove rid. If tombstone is true, its row is kept and marked
+        as deleted, so that it is written to the index as such."""
+        row = super().remove(rid)
+        if tombstone:
+            self.compression_type[row] = COMPRESSION_DELETED
+            self._tombstones[index.pack_rid(rid)] = row
+        return row
+
+    def index_rows(self):
+        """The rows that belong in the on-disk index, in order: every live
+        row, plus the tombstones of removed resources."""
+        live = set(self._rows.values())
+        return [row for row in range(len(self.type))
+                if row in live
+                or self.compression_type[row] == COMPRESSION_DELETED]
 
 class _DbpfReader(utils.BinPacker):
     _Header = namedtuple('_Header',
                          'file_version user_version ctime ' +
                          'mtime index_count index_pos index_size')
+
+    def __init__(self, bstr, mode="r"):
+        super().__init__(bstr, mode)
+        # When we're reading from a memory map, blobs can be handed
+        # out as slices of the mapping instead of being read into a
+        # fresh bytes object.
+        if isinstance(bstr, mmap.mmap):
+            self.view = memoryview(bstr)
+        else:
+            self.view = None
+
+    def get_blob(self, offset, length):
+        """Return length bytes starting at offset. If the file is
+        memory-mapped, this is a zero-copy memoryview into the mapping;
+        otherwise, it's a bytes object."""
+        if self.view is not None:
+            if offset + length > self.raw_len:
+                raise utils.FormatException("Resource runs off end of file")
+            return self.view[offset:offset + length]
+        with self.at(offset):
+            return self.get_raw_bytes(length)
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            try:
+                super().close()
+            except BufferError:
+                # Somebody still holds a view of the mapping (content
+                # that get_blob handed out); it's unmapped once the
+                # last of those is released.
+                pass
+        else:
+            super().close()
+
     @property
     def header(self):
         if hasattr(self, "_header"):
@@ -24,6 +140,8 @@ class _DbpfReader(utils.BinPacker):
             if self.get_raw_bytes(4) != b'DBPF':
                 raise utils.FormatException(
                     "Not a valid DBPF file; invalid magic")
+            if self.raw_len < 96:
+                raise utils.FormatException("Truncated header")
 
             fileVersion = (self.get_uint32(), self.get_uint32())
             if fileVersion != (2,1):
@@ -51,65 +169,305 @@ class _DbpfReader(utils.BinPacker):
                                         indexRecordSize)
             return self._header
 
-    def get_index(self, package=None):
-        # Package is used for the package field in Resource
-        # This doesn't cache at all.
-        _CONST_TYPE = 1
-        _CONST_GROUP = 2
-        _CONST_INSTAMCE_EX = 4
+    def get_index_columns(self):
+        """Read and decode the whole index in one go.
+
+        Returns a tuple of eight equal-length sequences: (type, group,
+        instance, offset, raw_len, size, compression_type,
+        compression_committed). Entries marked as deleted are
+        included; it's up to the caller to skip them.
+
+        """
         header = self.header
         if header.index_pos == 0:
             if header.index_count != 0:
                 raise utils.FormatException(
                     "Package contains entries but no index")
-            return
+            return ((),) * 8
+        count = header.index_count
+        if header.index_pos + header.index_size > self.raw_len:
+            raise utils.FormatException("Truncated index")
 
         with self.at(header.index_pos):
-            flags = self.get_uint32()
-            if flags & _CONST_TYPE:        entry_type    = self.get_uint32()
-            if flags & _CONST_GROUP:       entry_group   = self.get_uint32()
-            if flags & _CONST_INSTAMCE_EX: entry_inst_ex = self.get_uint32()
-
-            for _ in range(header.index_count):
-                if not flags & _CONST_TYPE:
-                    entry_type    = self.get_uint32()
-                if not flags & _CONST_GROUP:
-                    entry_group   = self.get_uint32()
-                if not flags & _CONST_INSTAMCE_EX:
-                    entry_inst_ex = self.get_uint32()
-                entry_inst = self.get_uint32()
-                entry_pos = self.get_uint32()
-                entry_size = self.get_uint32()
-                entry_size_decompressed = self.get_uint32()
-                if entry_size & 0x80000000:
-                    entry_compressed = (self.get_uint16(), self.get_uint16())
-                else:
-                    entry_compressed = (0,1)
-                entry_size &= 0x7FFFFFFF
-                locator = DbpfLocator(entry_pos, entry_size, entry_compressed)
-                with self.at(None):
-                    yield resource.Resource(
-                        resource.ResourceID(entry_group,
-                                            entry_inst_ex << 32 | entry_inst,
-                                            entry_type),
-                        locator,
-                        entry_size_decompressed,
-                        package)
+            block = self.get_raw_bytes(header.index_size)
+        if len(block) < 4:
+            raise utils.FormatException("Truncated index")
+        flags, = _uint32.unpack_from(block, 0)
+        # For each of type, group, and instance_ex, either the
+        # constant value from the index header or the column of the
+        # entry records that it lives in.
+        consts = [bool(flags & bit) for bit in (_CONST_TYPE, _CONST_GROUP,
+                                                _CONST_INSTANCE_EX)]
+        nconst = sum(consts)
+        const_values = list(struct.unpack_from("<%dI" % nconst, block, 4))
+        body = memoryview(block)[4 + 4 * nconst:]
+        nvar = 3 - nconst + 4 # uint32s in each entry, before compression
+        size_col = nvar - 2
+
+        rows = None
+        long_entry = struct.Struct("<%dIHH" % nvar)
+        short_entry = struct.Struct("<%dI" % nvar)
+        # Almost every package either sets the extended compression
+        # bit on every entry or on none of them, in which case all the
+        # entries are the same size and can be decoded in bulk.
+        if len(body) >= count * long_entry.size:
+            rows = list(long_entry.iter_unpack(
+                body[:count * long_entry.size]))
+            if not all(row[size_col] & 0x80000000 for row in rows):
+                rows = None
+        if rows is None and len(body) >= count * short_entry.size:
+            rows = list(short_entry.iter_unpack(
+                body[:count * short_entry.size]))
+            if any(row[size_col] & 0x80000000 for row in rows):
+                rows = None
+            else:
+                columns = list(zip(*rows)) or [()] * nvar
+                columns.append((0,) * count)
+                columns.append((1,) * count)
+        elif rows is not None:
+            columns = list(zip(*rows)) or [()] * (nvar + 2)
+        if rows is None:
+            # Mixed index; fall back to decoding one entry at a time
+            rows = []
+            pos = 0
+            try:
+                for _ in range(count):
+                    row = short_entry.unpack_from(body, pos)
+                    if row[size_col] & 0x80000000:
+                        row = long_entry.unpack_from(body, pos)
+                        pos += long_entry.size
+                    else:
+                        row += (0, 1)
+                        pos += short_entry.size
+                    rows.append(row)
+            except struct.error:
+                raise utils.FormatException("Truncated index")
+            columns = list(zip(*rows)) or [()] * (nvar + 2)
+
+        fixed = []
+        for is_const in consts:
+            if is_const:
+                fixed.append((const_values.pop(0),) * count)
+            else:
+                fixed.append(columns.pop(0))
+        entry_type, entry_group, entry_inst_ex = fixed
+        entry_inst, entry_pos, entry_size, entry_size_decompressed, \
+            entry_ctype, entry_committed = columns
+        instance = [hi << 32 | lo
+                    for hi, lo in zip(entry_inst_ex, entry_inst)]
+        raw_len = [size & 0x7FFFFFFF for size in entry_size]
+        return (entry_type, entry_group, instance, entry_pos, raw_len,
+                entry_size_decompressed, entry_ctype, entry_committed)
+
+    def get_index(self, package=None):
+        # Package is used for the package field in Resource
+        # This doesn't cache at all.
+        for (entry_type, entry_group, entry_inst, entry_pos, entry_size,
+             entry_size_decompressed, entry_ctype,
+             entry_committed) in zip(*self.get_index_columns()):
+            locator = DbpfLocator(entry_pos, entry_size,
+                                  (entry_ctype, entry_committed))
+            yield resource.Resource(
+                resource.ResourceID(entry_group, entry_inst, entry_type),
+                locator,
+                entry_size_decompressed,
+                package)
+
+# Maps the name of a compression method to a function that takes the
+# content and a compression level and returns (compressed content,
+# compression type). Only zlib pays attention to the level.
+COMPRESSORS = {
+    'none': lambda content, level: (content, COMPRESSION_NONE),
+    'zlib': lambda content, level: (zlib.compress(content, level),
+                                    COMPRESSION_ZLIB),
+    'refpack': lambda content, level: (encodeRefPack(content),
+                                       COMPRESSION_REFPACK),
+}
+
+# Sort keys for the named layouts accepted by layout_order
+LAYOUTS = {
+    'type': lambda rid: (rid.type, rid.group, rid.instance),
+    'instance': lambda rid: (rid.instance, rid.type, rid.group),
+}
+
+def layout_order(rids, layout=None):
+    """Return the ResourceIDs in rids as a list, in the order they
+    should be laid out in a package file. Resources that are read
+    together should be stored together, so that readahead (or the page
+    cache, for mmap'd packages) serves them all.
+
+    layout may be None to keep the order given, the name of one of
+    LAYOUTS ("type" groups resources by type, "instance" sorts them by
+    instance), or a sequence of ResourceIDs, such as an access trace,
+    in which case those resources come first, in trace order, followed
+    by the rest in the order given.
+
+    """
+    rids = list(rids)
+    if layout is None:
+        return rids
+    if isinstance(layout, str):
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown layout %r" % (layout,))
+        return sorted(rids, key=LAYOUTS[layout])
+    present = set(rids)
+    first = [rid for rid in dict.fromkeys(layout) if rid in present]
+    listed = set(first)
+    return first + [rid for rid in rids if rid not in listed]
+
+class CompressionPolicy:
+    """Decides how each resource written to a DbpfPackage gets
+    compressed.
+
+    method is the default compression method (a key of COMPRESSORS),
+    and level is passed to it. type_methods maps resource types to the
+    method to use for that type instead; e.g., {0x2F7D0004: 'none'}
+    stores PNG images as-is. Resources smaller than min_size bytes are
+    always stored uncompressed, and if store_if_larger is true, so is
+    anything that compression fails to shrink.
+
+    """
+
+    def __init__(self, method="zlib", level=-1, type_methods=None,
+                 min_size=0, store_if_larger=True):
+        self.method = method
+        self.level = level
+        self.type_methods = dict(type_methods or {})
+        self.min_size = min_size
+        self.store_if_larger = store_if_larger
+        for method in itertools.chain((self.method,),
+                                      self.type_methods.values()):
+            if method not in COMPRESSORS:
+                raise ValueError("Unknown compression method %r" % (method,))
+
+    def method_for(self, rid, size):
+        """The name of the compression method for size bytes of rid"""
+        if size < self.min_size:
+            return 'none'
+        return self.type_methods.get(rid.type, self.method)
+
+    def compress(self, rid, content):
+        """Return (compressed content, compression type) for content"""
+        method = self.method_for(rid, len(content))
+        if method == 'none':
+            return content, COMPRESSION_NONE
+        zcontent, ctype = COMPRESSORS[method](content, self.level)
+        if self.store_if_larger and len(zcontent) >= len(content):
+            return content, COMPRESSION_NONE
+        return zcontent, ctype
 
 class _DbpfWriter:
-    def __init__(self, fstream):
+    def __init__(self, fstream, compression="zlib", append=False):
+        if not isinstance(compression, CompressionPolicy):
+            compression = CompressionPolicy(compression)
+        self.policy = compression
+        self.compress = compression.compress
         self.f = utils.BinPacker(fstream, mode="w")
-        # Skip over header. The official docs say the header is 92
-        # bytes, but all the RE'd docs say 96. Treating an extra 4
-        # bytes as reserved won't hurt, so we just use 96 here
-        self.f.off = 96
+        self.append = append
+        if append:
+            # Leave everything that's already there alone
+            self.f.off = max(self.f.raw_len, 96)
+        else:
+            # Skip over header. The official docs say the header is 92
+            # bytes, but all the RE'd docs say 96. Treating an extra 4
+            # bytes as reserved won't hurt, so we just use 96 here
+            self.f.off = 96
     def put_rsrc(self, rid, content):
+        return self.put_compressed(*self.compress(rid, content))
+    def put_compressed(self, zcontent, ctype, committed=1):
+        """Write already-compressed content and return its locator"""
         off = self.f.off
-        zcontent = zlib.compress(content)
         self.f.put_raw_bytes(zcontent)
-        locator = DbpfLocator(off, len(zcontent), (0x5A42, 1))
+        locator = DbpfLocator(off, len(zcontent), (ctype, committed))
         return locator
-    def write_index(self, idx):
+    def put_stream(self, stream, method, level=-1):
+        """Write everything read from the file-like stream, compressed
+        with method ('none' or 'zlib') a piece at a time. If the policy
+        says to store content that compression fails to shrink as-is,
+        that's done here too. Returns the locator and the uncompressed
+        size."""
+        off = self.f.off
+        if method == 'zlib':
+            z = zlib.compressobj(level)
+            ctype = COMPRESSION_ZLIB
+        elif method == 'none':
+            z = None
+            ctype = COMPRESSION_NONE
+        else:
+            raise ValueError("Can't stream compression method %r" % (method,))
+        size = 0
+        while True:
+            chunk = stream.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            size += len(chunk)
+            self.f.put_raw_bytes(z.compress(chunk) if z else chunk)
+        if z:
+            self.f.put_raw_bytes(z.flush())
+            if self.policy.store_if_larger and self.f.off - off >= size:
+                # The stream can't necessarily be rewound, so get the
+                # content back by decompressing what was just written
+                end = self.f.off
+                pos = off
+                def read(count):
+                    nonlocal pos
+                    with self.f.at(pos):
+                        blob = self.f.get_raw_bytes(min(count, end - pos))
+                    pos += len(blob)
+                    return blob
+                with tempfile.TemporaryFile() as spool:
+                    for chunk in iterZlib(read):
+                        spool.write(chunk)
+                    spool.seek(0)
+                    self.f.off = off
+                    shutil.copyfileobj(spool, self.f.raw, STREAM_CHUNK)
+                ctype = COMPRESSION_NONE
+        return DbpfLocator(off, self.f.off - off, (ctype, 1)), size
+    def put_range(self, reader, offset, length):
+        """Copy length bytes starting at offset in the _DbpfReader reader
+        to the end of the output. Returns the offset they were written
+        to. Where possible, the copy happens entirely in the kernel."""
+        dest = self.f.off
+        copied = 0
+        if reader.view is None and hasattr(os, "copy_file_range"):
+            # The kernel copies what's on disk, so neither side can
+            # have writes sitting in a buffer. (The source may be a
+            # package open in append mode.)
+            reader.raw.flush()
+            self.f.raw.flush()
+            try:
+                src_fd = reader.raw.fileno()
+                dst_fd = self.f.raw.fileno()
+                while copied < length:
+                    count = os.copy_file_range(src_fd, dst_fd,
+                                               length - copied,
+                                               offset + copied,
+                                               dest + copied)
+                    if count == 0:
+                        break
+                    copied += count
+            except (OSError, io.UnsupportedOperation):
+                # Not supported between these files; do it the slow way
+                pass
+            self.f.off = dest + copied
+        while copied < length:
+            chunk = min(length - copied, 1 << 20)
+            blob = reader.get_blob(offset + copied, chunk)
+            if len(blob) == 0:
+                raise utils.FormatException("Resource runs off end of file")
+            self.f.put_raw_bytes(blob)
+            copied += len(blob)
+        return dest
+    def close(self):
+        self.f.close()
+    def write_index(self, idx, base_header=None):
+        """Write the index at the current position, followed by the
+        header. The versions and creation time are taken from
+        base_header, if given.
+
+        Content written afterwards normally overwrites the index. In
+        append mode, it goes after the index instead, so that the file
+        on disk stays valid until the next commit."""
         with self.f.at(None):
             idx_start = self.f.off
             idx_count = 0
@@ -122,24 +480,37 @@ class _DbpfWriter:
             # the file is very small, in which case who cares?
             self.f.put_uint32(0) # No flags
 
-            for rsrc in idx.values():
+            for row in idx.index_rows():
                 idx_count += 1
-                self.f.put_uint32(rsrc.id.type)
-                self.f.put_uint32(rsrc.id.group)
-                self.f.put_uint32(rsrc.id.instance >> 32)
-                self.f.put_uint32(rsrc.id.instance & 0xFFFFFFFF)
-                self.f.put_uint32(rsrc.locator.offset)
-                if rsrc.locator.raw_len & 0x80000000 != 0:
-                    raise FormatException("File must be smaller than 2GB")
-                # We always compress, so we always need the ExtendedCompression
-                # bit set
-                self.f.put_uint32(rsrc.locator.raw_len | 0x80000000)
-                self.f.put_uint32(rsrc.size)
-                self.f.put_uint16(rsrc.locator.compression[0])
-                self.f.put_uint16(rsrc.locator.compression[1])
+                self.f.put_uint32(idx.type[row])
+                self.f.put_uint32(idx.group[row])
+                self.f.put_uint32(idx.instance[row] >> 32)
+                self.f.put_uint32(idx.instance[row] & 0xFFFFFFFF)
+                self.f.put_uint32(idx.offset[row])
+                if idx.raw_len[row] & 0x80000000 != 0:
+                    raise utils.FormatException("File must be smaller than 2GB")
+                # The extended compression field is also what says
+                # whether a resource is compressed at all, so we
+                # always write it
+                self.f.put_uint32(idx.raw_len[row] | 0x80000000)
+                self.f.put_uint32(idx.size[row])
+                self.f.put_uint16(idx.compression_type[row])
+                self.f.put_uint16(idx.compression_committed[row])
             idx_end = self.f.off
-        header = _DbpfReader._Header((2,1), (0,0), 0,0,
-                                     idx_count, idx_start, idx_end - idx_start)
+            # Nothing past the index is live: it's left over from an
+            # earlier, longer index, or from a compressed attempt at a
+            # resource that put_stream then stored as-is
+            self.f.raw.truncate(idx_end)
+        if self.append:
+            self.f.off = idx_end
+        if base_header is None:
+            header = _DbpfReader._Header((2,1), (0,0), 0,0,
+                                         idx_count, idx_start,
+                                         idx_end - idx_start)
+        else:
+            header = base_header._replace(index_count=idx_count,
+                                          index_pos=idx_start,
+                                          index_size=idx_end - idx_start)
         self.put_header(header)
     def put_header(self, header):
         with self.f.at(0):
@@ -165,55 +536,171 @@ class _DbpfWriter:
 class DbpfPackage(AbstractPackage):
     """A Sims4 DBPF file. This is the format in Sims4 packages, worlds, etc"""
 
-    def __init__(self, name, mode="r"):
+    def __init__(self, name, mode="r", use_mmap=False, compression="zlib",
+                 jobs=1, dedup=False):
+        """Open a DBPF package. mode is "r" to read, "w" to create a
+        new package (truncating any existing file), or "a" (or "r+")
+        to update an existing package in place. In append mode, new
+        content is added to the end of the file, removed resources are
+        marked as deleted, and commit() writes a fresh index; nothing
+        already in the file is rewritten.
+
+        If use_mmap is true and the package is opened for reading, the
+        file is memory-mapped and resource content is read straight out
+        of the mapping; uncompressed resources are then returned as
+        memoryviews rather than bytes. Those views stay valid after the
+        package is closed; the file is unmapped once they've all been
+        released.
+
+        compression selects how resources written to the package are
+        compressed; it may be either a CompressionPolicy or the name of
+        a compression method (one of the keys of COMPRESSORS). If jobs
+        is greater than one, resources are compressed by that many
+        worker threads while earlier ones are being written. The
+        output is the same as with a single job.
+
+        If dedup is true, resources with identical content are only
+        stored (and compressed) once; the index entries for the copies
+        all point at the same data. The number of bytes of file this
+        saved is kept in dedup_saved.
+
+        """
         super().__init__()
+        self._open_args = dict(mode=mode, use_mmap=use_mmap,
+                               compression=compression, jobs=jobs,
+                               dedup=dedup)
         if isinstance(name, io.RawIOBase):
+            self.name = None
             self.file = _DbpfReader(name)
+            self._index_cache = None
+            self.writable = False
         else:
+            self.name = name
             if mode == 'r':
-                self.file = _DbpfReader(open(name, "rb"))
+                if use_mmap:
+                    with open(name, "rb") as f:
+                        try:
+                            mapping = mmap.mmap(f.fileno(), 0,
+                                                access=mmap.ACCESS_READ)
+                        except ValueError:
+                            # mmap refuses empty files
+                            raise utils.FormatException(
+                                "Not a valid DBPF file; file is empty")
+                    self.file = _DbpfReader(mapping)
+                else:
+                    self.file = _DbpfReader(open(name, "rb"))
                 self._index_cache = None
                 self.writable = False
             elif mode == 'w':
-                self.file = _DbpfWriter(open(name, "w+b"))
-                self._index_cache = {}
+                self.file = self._writer = _DbpfWriter(open(name, "w+b"),
+                                                       compression)
+                self._index_cache = DbpfIndex()
+                self._base_header = None
+                self._dirty = True
                 self.writable = True
-    def scan_index(self, filter=None):
+            elif mode in ('a', 'r+'):
+                # The reader and writer share a file object. All the
+                # reader's accesses are wrapped in at(), so they leave
+                # the writer's position alone.
+                f = open(name, "r+b")
+                self.file = _DbpfReader(f, mode="w")
+                self._index_cache = self._load_index()
+                self._base_header = self.file.header
+                self._writer = _DbpfWriter(f, compression, append=True)
+                self._dirty = False
+                self.writable = True
+            else:
+                raise ValueError("Invalid mode %r" % (mode,))
+            if self.writable:
+                if jobs > 1:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(jobs)
+                    self._max_pending = 2 * jobs
+                else:
+                    self._pool = None
+                # (rid, size, future, digest) for each resource that
+                # has been put but not yet written, in the order they
+                # were put. future is None for duplicates.
+                self._pending = collections.deque()
+                # Maps content digests to the locator of the stored
+                # copy, or None if that copy is still pending. The
+                # digests put() and put_raw() compute are tagged with
+                # 'content' and 'raw', so they can never match.
+                self._blobs = {} if dedup else None
+                self.dedup_saved = 0
+
+    def _load_index(self):
+        columns = self.file.get_index_columns()
+        if COMPRESSION_DELETED in columns[6]:
+            live = [ctype != COMPRESSION_DELETED for ctype in columns[6]]
+            columns = [list(itertools.compress(column, live))
+                       for column in columns]
+        return DbpfIndex.from_columns(*columns)
+
+    @property
+    def _index(self):
         if self._index_cache is None:
-            self._index_cache = {}
-            for item in self.file.get_index(self):
-                if item.locator.deleted:
-                    continue
-                self._index_cache[item.id] = item
+            self._index_cache = self._load_index()
+        return self._index_cache
+
+    def __contains__(self, rid):
+        return rid in self._index
 
-        for key in self._index_cache:
-            if filter is None or filter.match(key):
-                yield key
+    def _index_keys(self):
+        return self._index.keys()
 
-    def __getitem__(self, resource):
-        if self._index_cache == None:
-            next(self.scan_index())
-        return self._index_cache[resource]
+    def scan_index(self, filter=None):
+        return self._index.scan(filter)
+
+    def __getitem__(self, rid):
+        idx = self._index
+        try:
+            row = idx.find(rid)
+        except KeyError:
+            raise KeyError(rid)
+        return resource.Resource(rid, idx.locator(row), idx.size[row], self)
 
     def _get_content(self, item):
         assert isinstance(item, resource.Resource)
         assert item.package is self
-        with self.file.at(item.locator.offset):
-            ibuf = self.file.get_raw_bytes(item.locator.raw_len)
+        ibuf = self.file.get_blob(item.locator.offset, item.locator.raw_len)
 
-        if item.locator.compression[0] == 0:
+        if item.locator.compression[0] == COMPRESSION_NONE:
             return ibuf # uncompressed
-        elif item.locator.compression[0] == 0xFFFE:
+        elif item.locator.compression[0] == COMPRESSION_STREAMABLE:
             # BUG: I'm guessing "streamable compression" is the same
             # as RefPack, with a limited buffer size. This may or may
             # not be true, and even if it is, I'd need to know the
             # size of the buffer to do anything sensible.
             return decodeRefPack(ibuf)
-        elif item.locator.compression[0] == 0xFFFF:
+        elif item.locator.compression[0] == COMPRESSION_REFPACK:
             return decodeRefPack(ibuf)
-        elif item.locator.compression[0] == 0x5A42:
+        elif item.locator.compression[0] == COMPRESSION_ZLIB:
             return zlib.decompress(ibuf, 15, item.size)
 
+    def _open_content(self, item):
+        assert isinstance(item, resource.Resource)
+        assert item.package is self
+        offset, length = item.locator.offset, item.locator.raw_len
+        end = offset + length
+        def read(size):
+            nonlocal offset
+            blob = self.file.get_blob(offset, min(size, end - offset))
+            offset += len(blob)
+            return blob
+
+        ctype = item.locator.compression[0]
+        if ctype == COMPRESSION_NONE:
+            chunks = iter(lambda: read(STREAM_CHUNK), b"")
+        elif ctype in (COMPRESSION_STREAMABLE, COMPRESSION_REFPACK):
+            # See the BUG note in _get_content
+            chunks = iterRefPack(read)
+        elif ctype == COMPRESSION_ZLIB:
+            chunks = iterZlib(read)
+        else:
+            raise utils.FormatException(
+                "Unknown compression type %04x" % (ctype,))
+        return io.BufferedReader(_ChunkReader(chunks), STREAM_CHUNK)
+
     def flush_index_cache(self):
         # If we're writable, the in-memory "cache" is actually the
         # *only* copy of the index, so it shouldn't be flushed.
@@ -221,80 +708,522 @@ class DbpfPackage(AbstractPackage):
             self._index_cache = None
 
     def commit(self):
-        if self.writable:
-            self.file.write_index(self._index_cache)
+        if self.writable and self._dirty:
+            self._flush_pending()
+            self._writer.write_index(self._index_cache, self._base_header)
+            self._writer.f.raw.flush()
+            self._dirty = False
     def put(self, rid, content):
-        if self.writable:
-            locator = self.file.put_rsrc(rid, content)
-            self._index_cache[rid] = resource.Resource(
-                rid, locator, len(content), self)
+        if not self.writable:
+            raise TypeError("Not a writable package")
+        self._dirty = True
+        digest = None
+        if self._blobs is not None:
+            digest = ('content', hashlib.sha256(content).digest())
+            if self._put_duplicate(rid, len(content), digest):
+                return
+        if self._pool is None:
+            locator = self._writer.put_rsrc(rid, content)
+            self._put_locator(rid, locator, len(content), digest)
+        else:
+            self._pending.append((rid, len(content),
+                                  self._pool.submit(self._writer.compress,
+                                                    rid, content),
+                                  digest))
+            while len(self._pending) > self._max_pending:
+                self._write_pending()
+    def put_stream(self, rid, stream, size=None):
+        """Store the content read from the file-like stream. size is
+        the length of the content, if known. Unless dedup is on,
+        resources of at least STREAM_MIN_SIZE bytes (or of unknown
+        size) that would be stored uncompressed or with zlib are
+        compressed and written a piece at a time, without ever holding
+        the whole resource in memory. Everything else goes through
+        put()."""
+        if not self.writable:
+            raise TypeError("Not a writable package")
+        method = self._writer.policy.method_for(
+            rid, STREAM_MIN_SIZE if size is None else size)
+        if (self._blobs is not None or method not in ('none', 'zlib')
+                or (size is not None and size < STREAM_MIN_SIZE)):
+            return self.put(rid, stream.read())
+        self._dirty = True
+        self._flush_pending()
+        locator, size = self._writer.put_stream(stream, method,
+                                                self._writer.policy.level)
+        self._put_locator(rid, locator, size, None)
+    def _put_duplicate(self, rid, size, digest):
+        # If digest has been seen before, make rid share its data and
+        # return True. Otherwise, claim digest for rid.
+        if digest not in self._blobs:
+            self._blobs[digest] = None
+            return False
+        if self._pending:
+            self._pending.append((rid, size, None, digest))
+        else:
+            self._put_locator(rid, self._blobs[digest], size, None)
+            self.dedup_saved += self._blobs[digest].raw_len
+        return True
+    def _put_locator(self, rid, locator, size, digest):
+        self._index_cache.put(rid, locator.offset, locator.raw_len,
+                              size, *locator.compression)
+        if digest is not None:
+            self._blobs[digest] = locator
+    def _write_pending(self):
+        # Write out the oldest pending resource, waiting for it to be
+        # compressed if necessary
+        rid, size, future, digest = self._pending.popleft()
+        if future is None:
+            locator = self._blobs[digest]
+            self.dedup_saved += locator.raw_len
+            digest = None
+        else:
+            locator = self._writer.put_compressed(*future.result())
+        self._put_locator(rid, locator, size, digest)
+
+    def get_raw(self, rid):
+        """Return (raw content, compression, size) for rid, where the raw
+        content is exactly as it is stored in the file and compression
+        is the locator's (type, committed) pair. Together, these can be
+        handed to put_raw on another package."""
+        item = self[rid]
+        return (self.file.get_blob(item.locator.offset, item.locator.raw_len),
+                item.locator.compression, item.size)
+
+    def put_raw(self, rid, raw, compression, size):
+        """Store already-compressed content. compression is a (type,
+        committed) pair, and size is the size of the decompressed
+        content."""
+        if not self.writable:
+            raise TypeError("Not a writable package")
+        self._dirty = True
+        digest = None
+        if self._blobs is not None:
+            digest = hashlib.sha256(b"%d:%d:" % tuple(compression))
+            digest.update(raw)
+            digest = ('raw', digest.digest())
+            if self._put_duplicate(rid, size, digest):
+                return
+        if self._pending:
+            # Keep our place in line behind resources that are still
+            # being compressed
+            future = concurrent.futures.Future()
+            future.set_result((raw,) + tuple(compression))
+            self._pending.append((rid, size, future, digest))
+            return
+        locator = self._writer.put_compressed(raw, *compression)
+        self._put_locator(rid, locator, size, digest)
+
+    def copy_from(self, src, rids=None, keep_order=False):
+        """Copy resources from the DbpfPackage src without decompressing
+        them. rids defaults to every resource in src.
+
+        Unless keep_order is true, the resources are copied in the
+        order they appear in src rather than the order given. Either
+        way, each contiguous run of them is copied in one go (with
+        os.copy_file_range, if the OS supports it), and resources that
+        share data in src also share it in the copy.
+
+        """
+        if not self.writable:
+            raise TypeError("Not a writable package")
+        self._dirty = True
+        if rids is None:
+            rids = src.scan_index()
+        if self._blobs is not None:
+            # Every resource needs to be hashed anyway, so there's
+            # nothing to be gained from copying runs
+            for rid in rids:
+                self.put_raw(rid, *src.get_raw(rid))
+            return
+        self._flush_pending()
+        if src.writable:
+            src._flush_pending()
+        sidx = src._index
+        rows = [sidx.find(rid) for rid in rids]
+        if not keep_order:
+            rows.sort(key=lambda row: (sidx.offset[row], sidx.raw_len[row]))
+        # Maps (offset, raw_len) in src to the offset it was copied to
+        copied = {}
+
+        def put_row(row, offset):
+            self._index_cache.put(sidx.rid(row), offset,
+                                  sidx.raw_len[row], sidx.size[row],
+                                  sidx.compression_type[row],
+                                  sidx.compression_committed[row])
+
+        def copy_run(run_rows, start, end):
+            dest = self._writer.put_range(src.file, start, end - start)
+            for row in run_rows:
+                offset = dest + sidx.offset[row] - start
+                copied[sidx.offset[row], sidx.raw_len[row]] = offset
+                put_row(row, offset)
+
+        run_rows = []
+        start = end = None
+        for row in rows:
+            offset = sidx.offset[row]
+            if (offset, sidx.raw_len[row]) in copied:
+                put_row(row, copied[offset, sidx.raw_len[row]])
+            elif run_rows and start <= offset <= end:
+                end = max(end, offset + sidx.raw_len[row])
+                run_rows.append(row)
+            else:
+                if run_rows:
+                    copy_run(run_rows, start, end)
+                run_rows = [row]
+                start, end = offset, offset + sidx.raw_len[row]
+        if run_rows:
+            copy_run(run_rows, start, end)
+
+    def compact(self, order=None):
+        """Rewrite the package file so that it contains only the live
+        resources, stored contiguously, and return the number of bytes
+        reclaimed. This drops deleted entries, superseded payloads,
+        old indexes, and padding.
+
+        order controls the layout of the rewritten file; see
+        layout_order. None keeps the current order of the payloads.
+
+        The package is reopened on the compacted file with the same
+        arguments it was originally opened with, except that a package
+        created with mode "w" is reopened in append mode.
+
+        """
+        if not self.writable:
+            raise TypeError("Not a writable package")
+        if self.name is None:
+            raise TypeError("Can only compact a package opened by name")
+        self.commit()
+        if isinstance(self.file, _DbpfReader):
+            src = self
         else:
+            # A package created with mode "w" can't read its own
+            # content, so read the committed file back in
+            src = DbpfPackage(self.name)
+        old_size = os.path.getsize(self.name)
+        idx = src._index
+        rids = layout_order(
+            sorted(idx, key=lambda rid: idx.offset[idx.find(rid)]), order)
+
+        fd, tmpname = tempfile.mkstemp(suffix=".package",
+                                       dir=os.path.dirname(
+                                           os.path.abspath(self.name)))
+        os.close(fd)
+        try:
+            shutil.copymode(self.name, tmpname)
+            out = DbpfPackage(tmpname, "w")
+            out._base_header = src.file.header
+            out.copy_from(src, rids, keep_order=True)
+            out.close()
+            if src is not self:
+                src.close()
+            self.close()
+            os.replace(tmpname, self.name)
+        except BaseException:
+            if src is not self:
+                src.close()
+            os.unlink(tmpname)
+            raise
+        new_size = os.path.getsize(self.name)
+        # Start over on the new file
+        open_args = dict(self._open_args)
+        if open_args["mode"] == "w":
+            open_args["mode"] = "a"
+        self.__init__(self.name, **open_args)
+        return old_size - new_size
+
+    def _flush_pending(self):
+        while self._pending:
+            self._write_pending()
+    def remove(self, rid):
+        """Remove rid from the package. In append mode, its index entry
+        is kept, marked as deleted."""
+        if not self.writable:
             raise TypeError("Not a writable package")
-    def close(close):
+        self._flush_pending()
+        try:
+            self._index_cache.remove(rid, tombstone=self._writer.append)
+        except KeyError:
+            raise KeyError(rid)
+        self._dirty = True
+
+    def close(self):
         super().close()
+        if self.writable and self._pool is not None:
+            self._pool.shutdown()
         self.file.close()
 
-def decodeRefPack(ibuf):
-    """Decode the DBPF compression. ibuf must quack like a bytes"""
-    # Based on http://simswiki.info/wiki.php?title=Sims_3:DBPF/Compression
-    # Sims4 compression has the first two bytes swapped
+class _ChunkReader(io.RawIOBase):
+    """A read-only raw stream over an iterator of bytes-like chunks"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self._chunk):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk).cast('B')
+        count = min(len(b), len(self._chunk))
+        b[:count] = self._chunk[:count]
+        self._chunk = self._chunk[count:]
+        return count
+
+    def close(self):
+        self._chunks = iter(())
+        self._chunk = memoryview(b"")
+        super().close()
+
+def iterZlib(read, chunk_size=STREAM_CHUNK):
+    """Incrementally decompress zlib data, yielding the output in
+    pieces of at most chunk_size bytes. read(n) must return up to n more
+    bytes of input, or an empty string at the end."""
+    z = zlib.decompressobj()
+    while not z.eof:
+        data = z.unconsumed_tail or read(chunk_size)
+        if not data:
+            raise utils.FormatException("Truncated zlib data")
+        out = z.decompress(data, chunk_size)
+        if out:
+            yield out
 
-    iptr = optr = 0
-    flags = ibuf[0]
-    if ibuf[1] != 0xFB:
+def _readRefPackHeader(ibuf):
+    # Returns (iptr, osize): where the control codes start, and the
+    # declared output size. Sims4 compression has the first two bytes
+    # swapped relative to the Sims 3 format.
+    if len(ibuf) < 2 or ibuf[1] != 0xFB:
         raise utils.FormatException("Invalid compressed data")
-    iptr = 2
-    osize = 0 # output size
-    for _ in range(4 if flags & 0x80 else 3):
-        osize = (osize << 8) | ibuf[iptr]
-        iptr += 1
+    iptr = 6 if ibuf[0] & 0x80 else 5
+    if len(ibuf) < iptr:
+        raise utils.FormatException("Invalid compressed data")
+    return iptr, int.from_bytes(ibuf[2:iptr], "big")
+
+def _readControlCode(ibuf, iptr, ilen):
+    # Returns (iptr, numPlaintext, numToCopy, copyOffset) for the
+    # control code at ibuf[iptr], with iptr moved past it. copyOffset
+    # is 0-indexed back from the end of the output, i.e. copyOffset=0
+    # means copying starts at the last byte written.
+    cc0 = ibuf[iptr]
+    if cc0 <= 0x7F:
+        if iptr + 2 > ilen:
+            raise utils.FormatException("Truncated control code")
+        cc1 = ibuf[iptr + 1]
+        return (iptr + 2, cc0 & 0x03, ((cc0 & 0x1C) >> 2) + 3,
+                ((cc0 & 0x60) << 3) + cc1)
+    elif cc0 <= 0xBF:
+        if iptr + 3 > ilen:
+            raise utils.FormatException("Truncated control code")
+        cc1 = ibuf[iptr + 1]
+        return (iptr + 3, (cc1 & 0xC0) >> 6, (cc0 & 0x3F) + 4,
+                ((cc1 & 0x3F) << 8) + ibuf[iptr + 2])
+    elif cc0 <= 0xDF:
+        if iptr + 4 > ilen:
+            raise utils.FormatException("Truncated control code")
+        return (iptr + 4, cc0 & 0x03, ((cc0 & 0x0C) << 6) + ibuf[iptr + 3] + 5,
+                ((cc0 & 0x10) << 12) + (ibuf[iptr + 1] << 8) + ibuf[iptr + 2])
+    elif cc0 <= 0xFB:
+        return iptr + 1, ((cc0 & 0x1F) << 2) + 4, 0, 0
+    else:
+        return iptr + 1, cc0 & 3, 0, 0
+
+def iterRefPack(read, chunk_size=STREAM_CHUNK):
+    """Incrementally decode RefPack data, yielding the output in pieces
+    of roughly chunk_size bytes. read(n) must return up to n more bytes
+    of input, or an empty string at the end. Only as much output as a
+    back-reference can reach is kept in memory. Like decodeRefPack,
+    short input is padded with zeros to the declared size."""
+    ibuf = bytearray()
+    while len(ibuf) < 6:
+        data = read(chunk_size)
+        if not data:
+            break
+        ibuf += data
+    iptr, osize = _readRefPackHeader(ibuf)
+
+    obuf = bytearray()
+    base = 0     # Number of output bytes already dropped from obuf
+    sent = 0     # Position in obuf up to which output has been yielded
+    eof = False
+    while True:
+        # The longest control code is 4 bytes, and the most plaintext
+        # one can carry is 112
+        if not eof and len(ibuf) - iptr < 116:
+            del ibuf[:iptr]
+            iptr = 0
+            while len(ibuf) < 116:
+                data = read(chunk_size)
+                if not data:
+                    eof = True
+                    break
+                ibuf += data
+        ilen = len(ibuf)
+        if iptr >= ilen:
+            break
+        iptr, numPlaintext, numToCopy, copyOffset = \
+            _readControlCode(ibuf, iptr, ilen)
 
+        # Copy from source
+        if numPlaintext:
+            if (base + len(obuf) + numPlaintext > osize
+                    or iptr + numPlaintext > ilen):
+                raise utils.FormatException("Invalid plaintext run")
+            obuf += ibuf[iptr:iptr+numPlaintext]
+            iptr += numPlaintext
+
+        # Copy from output
+        if numToCopy:
+            optr = len(obuf)
+            src = optr - 1 - copyOffset
+            if src < 0 or base + optr + numToCopy > osize:
+                raise utils.FormatException("Invalid back-reference")
+            dist = optr - src
+            if numToCopy <= dist:
+                obuf += obuf[src:src+numToCopy]
+            else:
+                obuf += (obuf[src:optr] * (numToCopy // dist + 1))[:numToCopy]
+
+        if len(obuf) - sent >= chunk_size:
+            yield bytes(obuf[sent:])
+            sent = len(obuf)
+            if sent > 2 * _REFPACK_WINDOW:
+                drop = sent - _REFPACK_WINDOW
+                del obuf[:drop]
+                base += drop
+                sent -= drop
+    if sent < len(obuf):
+        yield bytes(obuf[sent:])
+    if base + len(obuf) < osize:
+        yield bytes(osize - base - len(obuf))
+
+def decodeRefPack(ibuf):
+    """Decode the DBPF compression. ibuf must quack like a bytes (a
+    memoryview is fine)"""
+    # Based on http://simswiki.info/wiki.php?title=Sims_3:DBPF/Compression
+    iptr, osize = _readRefPackHeader(ibuf)
     obuf = bytearray(osize)
-    while iptr < len(ibuf):
-        numPlaintext = numToCopy = copyOffset = 0
-        # Copyoffset is 0-indexed back from obuf[optr]
-        # I.e., copyoffset=0 ==> copying starts at obuf[optr-1]
-
-        # Read a control code
-        cc0 = ibuf[iptr]; iptr+=1
-        if cc0 <= 0x7F:
-            cc1 = ibuf[iptr]; iptr+=1
-            cc = (cc0,cc1)
-            numPlaintext = cc0 & 0x03
-            numToCopy = ((cc0 & 0x1C) >> 2) + 3
-            copyOffset = ((cc0 & 0x60) << 3) + cc1
-        elif cc0 <= 0xBF:
-            cc1 = ibuf[iptr]; iptr+=1
-            cc2 = ibuf[iptr]; iptr+=1
-            cc = (cc0,cc1,cc2)
-            numPlaintext = (cc1 & 0xC0) >> 6
-            numToCopy = (cc0 & 0x3F) + 4
-            copyOffset = ((cc1 & 0x3F) << 8) + cc2
-        elif cc0 <= 0xDF:
-            cc1 = ibuf[iptr]; iptr+=1
-            cc2 = ibuf[iptr]; iptr+=1
-            cc3 = ibuf[iptr]; iptr+=1
-            cc = (cc0,cc1,cc2,cc3)
-            numPlaintext = cc0 & 0x03
-            numToCopy = ((cc0 & 0x0C) << 6) + cc3 + 5
-            copyOffset = ((cc0 & 0x10) << 12) + (cc1 << 8) + cc2
-        elif cc0 <= 0xFB:
-            cc = (cc0,)
-            numPlaintext = ((cc0 & 0x1F) << 2) + 4
-            numToCopy = 0
-        else:
-            cc = (cc0,)
-            numPlaintext = cc0 & 3
-            numToCopy = 0
+    optr = 0
+    ilen = len(ibuf)
+    while iptr < ilen:
+        iptr, numPlaintext, numToCopy, copyOffset = \
+            _readControlCode(ibuf, iptr, ilen)
 
         # Copy from source
-        obuf[optr:optr+numPlaintext] = ibuf[iptr:iptr+numPlaintext]
-        iptr += numPlaintext
-        optr += numPlaintext
+        if numPlaintext:
+            if optr + numPlaintext > osize or iptr + numPlaintext > ilen:
+                raise utils.FormatException("Invalid plaintext run")
+            obuf[optr:optr+numPlaintext] = ibuf[iptr:iptr+numPlaintext]
+            iptr += numPlaintext
+            optr += numPlaintext
 
         # Copy from output
-        for _ in range(numToCopy):
-            obuf[optr] = obuf[optr - 1 - copyOffset]
-            optr += 1
+        if numToCopy:
+            src = optr - 1 - copyOffset
+            if src < 0 or optr + numToCopy > osize:
+                raise utils.FormatException("Invalid back-reference")
+            dist = optr - src
+            if numToCopy <= dist:
+                obuf[optr:optr+numToCopy] = obuf[src:src+numToCopy]
+            else:
+                # The copy overlaps its own output, which just repeats
+                # the last dist bytes.
+                pattern = obuf[src:optr] * (numToCopy // dist + 1)
+                obuf[optr:optr+numToCopy] = pattern[:numToCopy]
+            optr += numToCopy
     # Done decompressing
     return bytes(obuf)
+
+def encodeRefPack(data, max_chain=32):
+    """Compress data with RefPack, in the byte order that decodeRefPack
+    expects. Matches are found with hash chains over three-byte
+    prefixes; max_chain bounds the number of candidates examined at
+    each position, trading compression ratio for speed."""
+    data = bytes(data)
+    size = len(data)
+    obuf = bytearray()
+    if size > 0xFFFFFF:
+        obuf += bytes((0x90, 0xFB)) + size.to_bytes(4, "big")
+    else:
+        obuf += bytes((0x10, 0xFB)) + size.to_bytes(3, "big")
+
+    head = {}            # prefix -> most recent position
+    chain = [-1] * size  # position -> previous position with same prefix
+    last = size - 3      # last position that has a full prefix
+    iptr = 0             # current position
+    litStart = 0         # start of the pending plaintext
+
+    def flushPlaintext(end):
+        # Emit all but the last 0-3 bytes of plaintext before end;
+        # those get folded into the next control code.
+        nonlocal litStart
+        while end - litStart > 3:
+            numPlaintext = min(112, (end - litStart) & ~3)
+            obuf.append(0xE0 | ((numPlaintext - 4) >> 2))
+            obuf.extend(data[litStart:litStart + numPlaintext])
+            litStart += numPlaintext
+
+    while iptr <= last:
+        prefix = data[iptr:iptr + 3]
+        cand = head.get(prefix, -1)
+        bestLen = bestDist = 0
+        maxLen = min(1028, size - iptr)
+        tries = max_chain
+        while cand >= 0 and tries:
+            dist = iptr - cand
+            if dist > 131072:
+                break
+            tries -= 1
+            # Only bother with candidates that could beat the best so far
+            if data[cand + bestLen] == data[iptr + bestLen]:
+                length = 3
+                while length < maxLen and data[cand + length] == data[iptr + length]:
+                    length += 1
+                if length > bestLen and (length >= 5
+                                         or (length == 4 and dist <= 16384)
+                                         or dist <= 1024):
+                    bestLen, bestDist = length, dist
+                    if length == maxLen:
+                        break
+            cand = chain[cand]
+
+        if not bestLen:
+            chain[iptr] = head.get(prefix, -1)
+            head[prefix] = iptr
+            iptr += 1
+            continue
+
+        flushPlaintext(iptr)
+        numPlaintext = iptr - litStart
+        copyOffset = bestDist - 1
+        if bestLen <= 10 and bestDist <= 1024:
+            obuf += bytes((((copyOffset >> 3) & 0x60) | ((bestLen - 3) << 2)
+                           | numPlaintext,
+                           copyOffset & 0xFF))
+        elif bestLen <= 67 and bestDist <= 16384:
+            obuf += bytes((0x80 | (bestLen - 4),
+                           (numPlaintext << 6) | (copyOffset >> 8),
+                           copyOffset & 0xFF))
+        else:
+            obuf += bytes((0xC0 | ((copyOffset >> 12) & 0x10)
+                           | (((bestLen - 5) >> 8) << 2) | numPlaintext,
+                           (copyOffset >> 8) & 0xFF,
+                           copyOffset & 0xFF,
+                           (bestLen - 5) & 0xFF))
+        obuf += data[litStart:iptr]
+
+        end = iptr + bestLen
+        for pos in range(iptr, min(end, last + 1)):
+            prefix = data[pos:pos + 3]
+            chain[pos] = head.get(prefix, -1)
+            head[prefix] = pos
+        iptr = litStart = end
+
+    flushPlaintext(size)
+    obuf.append(0xFC | (size - litStart))
+    obuf += data[litStart:]
+    return bytes(obuf)
@@ -1,12 +1,18 @@
 import os.path
+import shutil
 from collections import namedtuple
 
 from .abstractpackage import AbstractPackage
+from . import index
 from .. import resource
 
 class FileLocator(namedtuple("FileLocator", "filename")):
     pass
 
+class DirIndex(index.ResourceIndex):
+    _columns = (('size', 'Q'),
+                ('filename', None))
+
 class DirPackage(AbstractPackage):
     """A dirpackage is the most versatile form of package: it is the only
     form that can be opened read/write. It is simply a loose
@@ -36,7 +42,7 @@ class DirPackage(AbstractPackage):
     def _index(self):
         if self._index_cache is not None:
             return self._index_cache
-        self._index_cache = {}
+        self._index_cache = DirIndex()
         for fname in os.listdir(self.path):
             fullpath = os.path.join(self.path, fname)
             if not os.path.isfile(fullpath):
@@ -47,31 +53,47 @@ class DirPackage(AbstractPackage):
                 # Ignore the file
                 pass
             else:
-                self._index_cache[rid] = resource.Resource(
-                    id=rid,
-                    locator = fullpath,
-                    size = os.stat(fullpath).st_size,
-                    package=self)
+                self._index_cache.put(rid, os.stat(fullpath).st_size,
+                                      fullpath)
         return self._index_cache
 
     def scan_index(self, filter=None):
-        for x in self._index:
-            if filter is None or filter.match(x):
-                yield x
+        return self._index.scan(filter)
 
     def _get_content(self, resource):
         return open(resource.locator, "rb").read()
+    def _open_content(self, resource):
+        return open(resource.locator, "rb")
     def __getitem__(self, rid):
-        return self._index[rid]
+        idx = self._index
+        try:
+            row = idx.find(rid)
+        except KeyError:
+            raise KeyError(rid)
+        return resource.Resource(
+            id=rid,
+            locator=idx.filename[row],
+            size=idx.size[row],
+            package=self)
+    def __contains__(self, rid):
+        return rid in self._index
+
+    def _index_keys(self):
+        return self._index.keys()
     def flush_index_cache(self):
         self._index_cache = None
 
     def put(self, rid, value):
+        self._uncache(rid)
         fname = os.path.join(self.path, rid.as_filename())
         with open(fname, "wb") as f:
             f.write(value)
-        self._index[rid] = resource.Resource(
-            id=rid,
-            locator=fname,
-            size=len(value),
-            package=self)
+        self._index.put(rid, len(value), fname)
+
+    def put_stream(self, rid, stream, size=None):
+        self._uncache(rid)
+        fname = os.path.join(self.path, rid.as_filename())
+        with open(fname, "wb") as f:
+            shutil.copyfileobj(stream, f)
+            size = f.tell()
+        self._index.put(rid, size, fname)
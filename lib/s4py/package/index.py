@@ -0,0 +1,240 @@
+# A compact, columnar in-memory index of the resources in a package.
+#
+# Keeping a Resource namedtuple (plus its ResourceID and locator) for
+# every entry costs several hundred bytes per resource, which adds up
+# quickly once a MetaPackage stacks the entire game. Instead, we keep
+# one array per field and a single dict from a packed integer key to
+# the row number. ResourceIDs and Resources are only materialized when
+# somebody asks for them.
+
+from array import array
+import itertools
+import struct
+import sys
+
+from .. import resource
+
+_count = struct.Struct("<Q")
+
+_MASK32 = 0xFFFFFFFF
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+def pack_rid(rid):
+    """Pack a ResourceID into a single (128-bit) integer. The packed
+    form sorts by type, then group, then instance."""
+    return rid.type << 96 | rid.group << 64 | rid.instance
+
+def unpack_rid(key):
+    """Inverse of pack_rid"""
+    return resource.ResourceID((key >> 64) & _MASK32,
+                               key & _MASK64,
+                               key >> 96)
+
+class SecondaryIndex:
+    """Partitions a collection of packed keys by type and by group, so
+    that filters that name a type or group only look at the matching
+    keys. Each partition is built the first time it's needed; the
+    owner must drop the SecondaryIndex whenever its keys change."""
+
+    def __init__(self, keys):
+        self._keys = keys
+        self._by_type = None
+        self._by_group = None
+
+    def _partition(self, field):
+        buckets = {}
+        if field == 'type':
+            for key in self._keys:
+                buckets.setdefault(key >> 96, []).append(key)
+        else:
+            for key in self._keys:
+                buckets.setdefault((key >> 64) & _MASK32, []).append(key)
+        return buckets
+
+    def with_type(self, type):
+        if self._by_type is None:
+            self._by_type = self._partition('type')
+        return self._by_type.get(type, ())
+
+    def with_group(self, group):
+        if self._by_group is None:
+            self._by_group = self._partition('group')
+        return self._by_group.get(group, ())
+
+    def with_types(self, types):
+        """All keys whose type is in the container types"""
+        if self._by_type is None:
+            self._by_type = self._partition('type')
+        return itertools.chain.from_iterable(
+            keys for type, keys in self._by_type.items() if type in types)
+
+    def scan(self, filter=None):
+        """Yield the ResourceIDs that match filter, which may be a
+        ResourceID, ResourceFilter, CompiledFilter, any other object
+        with a match method, or None to match everything."""
+        if filter is None:
+            return map(unpack_rid, self._keys)
+        if isinstance(filter, resource.ResourceID):
+            if pack_rid(filter) in self._keys:
+                return iter((filter,))
+            return iter(())
+        rids = getattr(filter, 'rids', None)
+        if rids is not None:
+            return iter(sorted((rid for rid in rids
+                                if pack_rid(rid) in self._keys),
+                               key=pack_rid))
+        # type and group are hints only when they are single values; a
+        # SetFilter's fields are ValueSets, which narrow by type just
+        # as types does
+        type = getattr(filter, 'type', None)
+        types = getattr(filter, 'types', None)
+        group = getattr(filter, 'group', None)
+        if isinstance(type, resource.ValueSet):
+            type, types = None, type
+        if isinstance(type, int):
+            keys = self.with_type(type)
+        elif types is not None:
+            keys = self.with_types(types)
+        elif isinstance(group, int):
+            keys = self.with_group(group)
+        else:
+            keys = self._keys
+        return (rid for rid in map(unpack_rid, keys) if filter.match(rid))
+
+class ResourceIndex:
+    """Parallel arrays of type, group, and instance, along with whatever
+    package-specific columns a subclass declares in _columns, plus a
+    hash from the packed resource key to the row.
+
+    Rows are never removed from the arrays; a row whose key is not in
+    the hash (because it was removed or replaced) is dead, and is
+    skipped by everything except code that walks the raw columns.
+
+    """
+
+    # Sequence of (name, typecode) pairs. A typecode of None means
+    # that the column is an ordinary list.
+    _columns = ()
+
+    def __init__(self):
+        self.type = array('I')
+        self.group = array('I')
+        self.instance = array('Q')
+        for name, typecode in self._columns:
+            setattr(self, name, array(typecode) if typecode else [])
+        self._rows = {}
+        self._secondary = None
+
+    @classmethod
+    def from_columns(cls, types, groups, instances, *columns):
+        """Build an index from already-decoded columns. Later
+        duplicates of a key win, as they would with put()."""
+        self = cls()
+        self.type.extend(types)
+        self.group.extend(groups)
+        self.instance.extend(instances)
+        for (name, _), column in zip(self._columns, columns):
+            getattr(self, name).extend(column)
+        self._rebuild_rows()
+        return self
+
+    def _rebuild_rows(self):
+        self._rows = {t << 96 | g << 64 | i: row
+                      for row, (t, g, i) in enumerate(
+                          zip(self.type, self.group, self.instance))}
+        self._secondary = None
+
+    @classmethod
+    def column_layout(cls):
+        """A string describing the binary layout used by dump(), which
+        depends on the platform's byte order and item sizes"""
+        codes = ['I', 'I', 'Q'] + [typecode for _, typecode in cls._columns]
+        return "%s:%s" % (sys.byteorder,
+                          ",".join("%s%d" % (code, array(code).itemsize)
+                                   for code in codes))
+
+    def _array_columns(self):
+        columns = [self.type, self.group, self.instance]
+        for name, typecode in self._columns:
+            if typecode is None:
+                raise TypeError("Index column %s can't be serialized" % (name,))
+            columns.append(getattr(self, name))
+        return columns
+
+    def dump(self, f):
+        """Write every row of the index to the binary file f, in the
+        native layout described by column_layout()"""
+        f.write(_count.pack(len(self.type)))
+        for column in self._array_columns():
+            f.write(column.tobytes())
+
+    @classmethod
+    def load(cls, f):
+        """Read an index written by dump()"""
+        self = cls()
+        count, = _count.unpack(f.read(_count.size))
+        for column in self._array_columns():
+            data = f.read(count * column.itemsize)
+            if len(data) != count * column.itemsize:
+                raise EOFError("Truncated index")
+            column.frombytes(data)
+        self._rebuild_rows()
+        return self
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, rid):
+        return pack_rid(rid) in self._rows
+
+    def __iter__(self):
+        return map(unpack_rid, self._rows)
+
+    def keys(self):
+        """The packed keys of all live rows"""
+        return self._rows.keys()
+
+    def scan(self, filter=None):
+        """Yield the ResourceIDs of live rows matching filter; see
+        SecondaryIndex.scan"""
+        if self._secondary is None:
+            self._secondary = SecondaryIndex(self._rows)
+        return self._secondary.scan(filter)
+
+    def find(self, rid):
+        """Return the row for rid. Raises KeyError if rid isn't present"""
+        return self._rows[pack_rid(rid)]
+
+    def rid(self, row):
+        return resource.ResourceID(self.group[row], self.instance[row],
+                                   self.type[row])
+
+    def rows(self):
+        """The live rows, in insertion order"""
+        return self._rows.values()
+
+    def put(self, rid, *values):
+        """Add or replace the entry for rid. values correspond to the
+        subclass's _columns. Returns the row number."""
+        key = pack_rid(rid)
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self.type)
+            self.type.append(rid.type)
+            self.group.append(rid.group)
+            self.instance.append(rid.instance)
+            for (name, _), value in zip(self._columns, values):
+                getattr(self, name).append(value)
+            self._rows[key] = row
+            self._secondary = None
+        else:
+            for (name, _), value in zip(self._columns, values):
+                getattr(self, name)[row] = value
+        return row
+
+    def remove(self, rid):
+        """Drop rid from the index, leaving its row in place as a dead
+        row. Returns the row number."""
+        row = self._rows.pop(pack_rid(rid))
+        self._secondary = None
+        return row
@@ -0,0 +1,79 @@
+# A sidecar cache of DBPF package indexes, so that opening a
+# metapackage doesn't need to re-read the index of every package in
+# the stack. Each cached index is keyed by the package's path, size,
+# and modification time; any package whose signature doesn't match is
+# simply read again.
+#
+# The file format is:
+#   magic ("S4IC"), version (uint32), layout length (uint16), layout
+#   entry count (uint32)
+#   for each entry:
+#     path length (uint16), path (UTF-8), size (uint64), mtime_ns (uint64)
+#     the index, as written by ResourceIndex.dump
+# where the layout is DbpfIndex.column_layout(); a cache written on a
+# platform with a different layout is ignored.
+
+import os
+import struct
+import tempfile
+
+from .dbpf import DbpfIndex
+
+MAGIC = b"S4IC"
+VERSION = 1
+
+_header = struct.Struct("<4sIH")
+_uint16 = struct.Struct("<H")
+_uint32 = struct.Struct("<I")
+_entry = struct.Struct("<QQ")
+
+def package_signature(filename):
+    """Return the (path, size, mtime_ns) triple that identifies this
+    version of a package file"""
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+def load(cache_name):
+    """Read a cache file, returning a dict mapping package signatures to
+    DbpfIndexes. A missing, stale, or corrupt cache yields an empty
+    dict."""
+    try:
+        with open(cache_name, "rb") as f:
+            magic, version, layout_len = _header.unpack(f.read(_header.size))
+            if magic != MAGIC or version != VERSION:
+                return {}
+            layout = f.read(layout_len).decode("utf-8")
+            if layout != DbpfIndex.column_layout():
+                return {}
+            count, = _uint32.unpack(f.read(_uint32.size))
+            entries = {}
+            for _ in range(count):
+                path_len, = _uint16.unpack(f.read(_uint16.size))
+                path = f.read(path_len).decode("utf-8")
+                size, mtime = _entry.unpack(f.read(_entry.size))
+                entries[path, size, mtime] = DbpfIndex.load(f)
+            return entries
+    except (OSError, EOFError, struct.error, UnicodeError):
+        return {}
+
+def save(cache_name, entries):
+    """Write a cache file from a dict mapping package signatures to
+    DbpfIndexes. The file is replaced atomically."""
+    layout = DbpfIndex.column_layout().encode("utf-8")
+    fd, tmpname = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(cache_name)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_header.pack(MAGIC, VERSION, len(layout)))
+            f.write(layout)
+            f.write(_uint32.pack(len(entries)))
+            for (path, size, mtime), idx in entries.items():
+                path = path.encode("utf-8")
+                f.write(_uint16.pack(len(path)))
+                f.write(path)
+                f.write(_entry.pack(size, mtime))
+                idx.dump(f)
+        os.replace(tmpname, cache_name)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
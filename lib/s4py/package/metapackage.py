@@ -1,48 +1,225 @@
+import collections
+import collections.abc
+import concurrent.futures
+
 from .abstractpackage import AbstractPackage
-from .. import resource
+from . import index
+
+class Conflict(collections.namedtuple("Conflict", "id winner shadowed")):
+    """A resource provided by more than one package in a stack. winner is
+    the package that provides it; shadowed lists the other providers,
+    from the top of the stack down."""
 
 class MetaPackage(AbstractPackage):
     """A stack of packages, where the last package added is the first
     package checked for a resource. Each package can be any object
     that implements the AbstractPackage interface.
+
+    By default, the indexes of all the packages are merged up front.
+    If lazy is true, nothing is merged; lookups probe each package in
+    turn, from the top of the stack down, remembering the results of
+    the last lookup_cache_size lookups (hits and misses alike), and
+    scan_index merges the packages' indexes as it goes.
     """
-    def __init__(self, package_list):
+    def __init__(self, package_list, lazy=False, lookup_cache_size=1024):
         super().__init__()
         self._package_list = package_list
-        self._reset_caches()
+        self.lazy = lazy
+        self._lookup_cache_size = lookup_cache_size
+        if lazy:
+            self._entry_cache = None
+            self._secondary = None
+            self._lookup_cache = collections.OrderedDict()
+        else:
+            self._reset_caches()
 
     @classmethod
-    def open(cls, filename):
+    def open(cls, filename, use_cache=True, jobs=None, **kwargs):
+        """Open a metapackage file, which lists one package per line.
+
+        The packages are opened, and their indexes loaded, by a pool
+        of jobs threads (by default, as many as ThreadPoolExecutor
+        picks; jobs=1 loads them one at a time). The stack order is
+        the order of the file regardless.
+
+        If use_cache is true, the indexes of the DBPF packages in the
+        stack are cached in a sidecar file (filename + ".idxcache"),
+        so that only packages that have changed since the last open
+        need their index read. Any other keyword arguments are passed
+        to the constructor.
+
+        """
         from .. import package
+        from .dbpf import DbpfPackage
+        from . import indexcache
         # Metapackages are always read-only
-        packages = []
         with open(filename, "r") as f:
-            for name in f.readlines():
-                name = name.strip("\uFEFF\n")
-                packages.append(package.open_package(name, mode="r"))
-        return cls(packages)
+            names = [name.strip("\uFEFF\n") for name in f.readlines()]
+
+        cache_name = filename + ".idxcache"
+        cached = indexcache.load(cache_name) if use_cache else {}
+
+        def load(name):
+            child = package.open_package(name, mode="r")
+            signature = None
+            if use_cache and isinstance(child, DbpfPackage):
+                signature = indexcache.package_signature(child.name)
+                if signature in cached:
+                    child._index_cache = cached[signature]
+            # Read the index now, while we're on a worker thread
+            child._index_keys()
+            return child, signature
+
+        if jobs == 1:
+            loaded = list(map(load, names))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+                loaded = list(pool.map(load, names))
+        packages = [child for child, _ in loaded]
+
+        if use_cache:
+            entries = {signature: child._index
+                       for child, signature in loaded
+                       if signature is not None}
+            if entries.keys() != cached.keys():
+                try:
+                    indexcache.save(cache_name, entries)
+                except OSError:
+                    # The cache is only an optimization
+                    pass
+        return cls(packages, **kwargs)
 
     def scan_index(self, filter=None):
-        if filter is None:
-            return self._entry_cache.keys()
-        return (rid for rid in self._entry_cache
-                    if filter.match(rid))
+        if self.lazy:
+            return self._scan_layers(filter)
+        if self._entry_cache is None:
+            self._reset_caches()
+        if self._secondary is None:
+            self._secondary = index.SecondaryIndex(self._entry_cache)
+        return self._secondary.scan(filter)
+
+    def _scan_layers(self, filter):
+        # Walk the packages from the top of the stack down, skipping
+        # anything that a higher package overrides. Only the keys of
+        # the packages above the bottom one are remembered, which is
+        # little enough when a handful of mods sit on the base game.
+        seen = set()
+        for layer in reversed(range(len(self._package_list))):
+            bottom = layer == 0
+            for rid in self._package_list[layer].scan_index(filter):
+                key = index.pack_rid(rid)
+                if key in seen:
+                    continue
+                if not bottom:
+                    seen.add(key)
+                yield rid
+
+    def _find_layer(self, key):
+        # Returns the layer that provides key, or None
+        cache = self._lookup_cache
+        try:
+            layer = cache[key]
+        except KeyError:
+            pass
+        else:
+            cache.move_to_end(key)
+            return layer
+        for layer in reversed(range(len(self._package_list))):
+            if key in self._package_list[layer]:
+                break
+        else:
+            layer = None
+        if self._lookup_cache_size:
+            cache[key] = layer
+            if len(cache) > self._lookup_cache_size:
+                cache.popitem(last=False)
+        return layer
+
+    def __contains__(self, key):
+        if self.lazy:
+            return self._find_layer(key) is not None
+        if self._entry_cache is None:
+            self._reset_caches()
+        return index.pack_rid(key) in self._entry_cache
+
+    def _index_keys(self):
+        if self.lazy:
+            return map(index.pack_rid, self.scan_index())
+        if self._entry_cache is None:
+            self._reset_caches()
+        return self._entry_cache.keys()
 
     def __getitem__(self, key):
-        return self._entry_cache[key]
+        if self.lazy:
+            layer = self._find_layer(key)
+            if layer is None:
+                raise KeyError(key)
+            return self._package_list[layer][key]
+        if self._entry_cache is None:
+            self._reset_caches()
+        try:
+            layer = self._entry_cache[index.pack_rid(key)]
+        except KeyError:
+            raise KeyError(key)
+        return self._package_list[layer][key]
 
     def _get_content(self, resource):
         # This should never actually get called as we shouldn't be in
         # the package field of any resources. Still, if somebody
         # *does* decide to call this method directly, it should work.
-        return _resource.package._get_content(resource)
+        return resource.package._get_content(resource)
+
+    def get_content(self, resource):
+        return resource.package.get_content(resource)
+
+    def _open_content(self, resource):
+        return resource.package._open_content(resource)
+
+    def conflicts(self, filter=None):
+        """Return a list of Conflicts, one for every resource that more
+        than one package in the stack provides, sorted by type, group,
+        and instance. Only the packages' indexes are consulted; no
+        content is read. If filter is given, only resources that it
+        matches are reported."""
+        layer_keys = []
+        seen = set()
+        duplicates = set()
+        for package in self._package_list:
+            keys = package._index_keys()
+            if not isinstance(keys, collections.abc.Set):
+                keys = set(keys)
+            layer_keys.append(keys)
+            duplicates.update(seen.intersection(keys))
+            seen.update(keys)
+        del seen
+
+        providers = {key: [] for key in duplicates}
+        for layer, keys in enumerate(layer_keys):
+            for key in duplicates.intersection(keys):
+                providers[key].append(self._package_list[layer])
+
+        result = []
+        for key in sorted(providers):
+            rid = index.unpack_rid(key)
+            if filter is not None and not filter.match(rid):
+                continue
+            packages = providers[key]
+            result.append(Conflict(rid, packages[-1], packages[-2::-1]))
+        return result
 
     def flush_index_cache(self):
         self._entry_cache = None
+        self._secondary = None
+        if self.lazy:
+            self._lookup_cache.clear()
     def _reset_caches(self):
-        from .. import stbl
+        # The entry cache maps the packed key of each resource to the
+        # position in the package list of the package that provides
+        # it. Later packages override earlier ones. The child packages
+        # keep their own (compact) indexes, so we don't store
+        # Resources here.
         self._entry_cache = {}
-        for package in self._package_list:
-            for id in package.scan_index():
-                self._entry_cache[id] = package[id]
-            package.flush_index_cache()
+        self._secondary = None
+        for layer, package in enumerate(self._package_list):
+            self._entry_cache.update(
+                dict.fromkeys(package._index_keys(), layer))
@@ -7,7 +7,13 @@ class Resource(namedtuple("Resource", 'id locator size package')):
     # info for the package object to read the content.
     @property
     def content(self):
-        return self.package._get_content(self)
+        return self.package.get_content(self)
+
+    def open(self):
+        """Return a read-only binary file object that streams the
+        content. Packages that support it decompress it a piece at a
+        time, so large resources needn't fit in memory."""
+        return self.package.open_content(self)
 
     def __eq__(self, other):
         return (self.id == other.id
@@ -94,3 +100,195 @@ class ResourceFilter:
         instance = ("%16x"%self.instance) if self.instance is not None else ""
         type = ("%08x"%self.type) if self.type is not None else ""
         return ":".join((group,instance,type))
+
+class ValueSet:
+    """A set of integers, made up of individual values and inclusive
+    (low, high) ranges. Used as a field constraint in SetFilter."""
+
+    __slots__ = ('values', 'ranges')
+
+    def __init__(self, values=(), ranges=()):
+        self.values = frozenset(values)
+        self.ranges = tuple(sorted(set(ranges)))
+
+    def __contains__(self, value):
+        if value in self.values:
+            return True
+        for low, high in self.ranges:
+            if low <= value <= high:
+                return True
+        return False
+
+    def union(self, other):
+        return ValueSet(self.values | other.values,
+                        self.ranges + other.ranges)
+
+    def single(self):
+        """The only value in the set, or None if there are several"""
+        if not self.ranges and len(self.values) == 1:
+            return next(iter(self.values))
+        if not self.values and len(self.ranges) == 1:
+            low, high = self.ranges[0]
+            if low == high:
+                return low
+        return None
+
+    def __str__(self):
+        items = ["%x" % (value,) for value in sorted(self.values)]
+        items.extend("%x-%x" % r for r in self.ranges)
+        return ",".join(items)
+
+class SetFilter:
+    """A resource filter whose fields are ValueSets (or None, for
+    "anything"); this matches iff every specified component of the RID
+    is in the corresponding set"""
+
+    __slots__ = ('group', 'instance', 'type')
+
+    def __init__(self, group=None, instance=None, type=None):
+        self.group = group
+        self.instance = instance
+        self.type = type
+
+    def match(self, rid):
+        return ((self.group is None or rid.group in self.group) and
+                (self.instance is None or rid.instance in self.instance) and
+                (self.type is None or rid.type in self.type))
+
+    def __str__(self):
+        return ":".join(str(f) if f is not None else ""
+                        for f in (self.group, self.instance, self.type))
+
+class NotFilter:
+    """Matches exactly the RIDs that the wrapped filter doesn't"""
+
+    __slots__ = ('filter',)
+
+    def __init__(self, filter):
+        self.filter = filter
+
+    def match(self, rid):
+        return not self.filter.match(rid)
+
+    def __str__(self):
+        return "!" + str(self.filter)
+
+def _value_set(value):
+    if value is None or isinstance(value, ValueSet):
+        return value
+    return ValueSet((value,))
+
+class CompiledFilter:
+    """The union of a number of filters, less the union of some negated
+    ones, reduced to set lookups where possible. Build these with
+    compile_filters.
+
+    Besides match, this exposes hints that package indexes use to
+    avoid looking at every key: rids is the complete set of matching
+    RIDs if the filter names them exactly, and types, if not None, is
+    a container holding the type of every RID that can match."""
+
+    __slots__ = ('match', 'rids', 'types', 'type', 'group', '_desc')
+
+    def __init__(self, match, rids, types, desc):
+        self.match = match
+        self.rids = rids
+        self.types = types
+        self.type = None
+        self.group = None
+        if types is not None:
+            self.type = types.single()
+        self._desc = desc
+
+    def __str__(self):
+        return self._desc
+
+def _compile_union(filters):
+    # Returns (match, rids, types) for the union of filters, which must
+    # be ResourceIDs, ResourceFilters, or SetFilters. Exact RIDs are
+    # collected into one set, filters that constrain only a single
+    # field are merged into one ValueSet per field, and everything
+    # else is checked one filter at a time.
+    rids = set()
+    single = {}
+    general = []
+    types = ValueSet()
+    constrained = True
+    for filter in filters:
+        if isinstance(filter, ResourceID):
+            rids.add(filter)
+            types = types.union(ValueSet((filter.type,)))
+            continue
+        fields = tuple(_value_set(getattr(filter, name))
+                       for name in ('group', 'instance', 'type'))
+        if fields[2] is None:
+            constrained = False
+        else:
+            types = types.union(fields[2])
+        named = [i for i, field in enumerate(fields) if field is not None]
+        if not named:
+            return (lambda rid: True), None, None
+        if len(named) == 1:
+            i = named[0]
+            single[i] = single[i].union(fields[i]) if i in single else fields[i]
+        else:
+            general.append(fields)
+
+    rids = frozenset(rids)
+    by_group = single.get(0)
+    by_instance = single.get(1)
+    by_type = single.get(2)
+    general = tuple(general)
+
+    def match(rid):
+        if rid in rids:
+            return True
+        if by_type is not None and rid.type in by_type:
+            return True
+        if by_group is not None and rid.group in by_group:
+            return True
+        if by_instance is not None and rid.instance in by_instance:
+            return True
+        for group, instance, type in general:
+            if ((group is None or rid.group in group) and
+                (instance is None or rid.instance in instance) and
+                (type is None or rid.type in type)):
+                return True
+        return False
+
+    if not single and not general:
+        return rids.__contains__, rids, types
+    return match, None, types if constrained else None
+
+def compile_filters(filters):
+    """Compile an iterable of filters into a CompiledFilter that matches
+    a RID iff it matches at least one of the filters (or there are
+    only negated filters) and none of the NotFilters. Returns None if
+    filters is empty, since that matches everything."""
+    filters = list(filters)
+    if not filters:
+        return None
+    positive = []
+    negative = []
+    for filter in filters:
+        # A NotFilter of a NotFilter is the filter itself
+        negated = False
+        while isinstance(filter, NotFilter):
+            filter = filter.filter
+            negated = not negated
+        (negative if negated else positive).append(filter)
+    desc = "(%s)" % (" | ".join(str(f) for f in filters),)
+
+    if positive:
+        match, rids, types = _compile_union(positive)
+    else:
+        match, rids, types = (lambda rid: True), None, None
+    if negative:
+        positive_match = match
+        excluded, _, _ = _compile_union(negative)
+        def combined(rid):
+            return positive_match(rid) and not excluded(rid)
+        match = combined
+        if rids is not None:
+            rids = frozenset(rid for rid in rids if not excluded(rid))
+    return CompiledFilter(match, rids, types, desc)
@@ -2,20 +2,65 @@
 # TDesc files. I'm not there yet. Thus, this module's interface is
 # likely to change *substantially* over the coming weeks.
 
+import collections.abc
 from collections import namedtuple
 from . import fnv1
 from . import resource
 from . import utils
+from array import array
+import bisect
 import contextlib
+import itertools
 import struct
 
 import yaml
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class FormatException(Exception):
     pass
 
 _dword = struct.Struct("=I")
 
+# For each data type: the struct format of its fields, its alignment,
+# and how SimDataReader._decodeColumn turns those fields into a value
+_LAYOUTS = {
+    0: ('b', 1, 'bool'),           # BOOL
+    1: ('B', 1, 'char'),           # CHAR8
+    2: ('b', 1, 'value'),          # INT8
+    3: ('B', 1, 'value'),          # UINT8
+    4: ('h', 2, 'value'),          # INT16
+    5: ('H', 2, 'value'),          # UINT16
+    6: ('i', 4, 'value'),          # INT32
+    7: ('I', 4, 'value'),          # UINT32
+    8: ('q', 8, 'value'),          # INT64
+    9: ('Q', 8, 'value'),          # UINT64
+    10: ('f', 4, 'value'),         # FLOAT
+    11: ('i', 4, 'string'),        # STRING8
+    12: ('iI', 4, 'string'),       # HASHEDSTRING8
+    13: ('i', 4, 'object'),        # OBJECT
+    14: ('iI', 4, 'vector'),       # VECTOR
+    15: ('2f', 4, 'tuple'),        # FLOAT2
+    16: ('3f', 4, 'tuple'),        # FLOAT3
+    17: ('4f', 4, 'tuple'),        # FLOAT4
+    18: ('Q', 8, 'tablesetref'),   # TABLESETREFERENCE
+    19: ('QII', 8, 'resourcekey'), # RESOURCEKEY
+    20: ('I', 4, 'lockey'),        # LOCKEY
+}
+
+_NULL_OFFSET = -0x80000000
+
+# Data types that ColumnTable can store (BOOL through FLOAT), and the
+# NumPy types they're stored as
+_COLUMNAR_TYPES = frozenset(range(11))
+_NUMPY_TYPES = {
+    'b': '<i1', 'B': '<u1', 'h': '<i2', 'H': '<u2', 'i': '<i4',
+    'I': '<u4', 'q': '<i8', 'Q': '<u8', 'f': '<f4',
+}
+
 
 
 class SimData:
@@ -30,11 +75,15 @@ class SimData:
         'name'
     ))
 
-    def __init__(self, schema):
-        schema_dict = {column.name: column
-                       for column in schema.columns}
-        value_dict = {column.name: None
-                      for column in schema.columns}
+    def __init__(self, schema, values=None, schema_dict=None):
+        if schema_dict is None:
+            schema_dict = {column.name: column
+                           for column in schema.columns}
+        if values is None:
+            value_dict = {column.name: None
+                          for column in schema.columns}
+        else:
+            value_dict = dict(values)
 
         # We do funny things with setattribute and getattribute that
         # refer to these values. To prevent using this class in a daft
@@ -94,12 +143,191 @@ def _represent_SimData(dumper, sd):
     return dumper.represent_mapping('!s4/tuning', mapping)
 yaml.add_representer(SimData, _represent_SimData)
 
+class ColumnTable:
+    """A table of SimData rows whose columns are all primitive values
+    (BOOL through FLOAT), stored column by column. Each column is a
+    NumPy array if NumPy is installed, or an array.array otherwise;
+    BOOL columns hold the decoded truth values, and CHAR8 columns hold
+    character codes. Indexing the table returns SimDataRow views.
+
+    Columns can be scanned without creating rows at all. For example,
+    with NumPy,
+
+        heavy = table.filter(table.column('weight') > 5)
+        total = table.column('weight').sum()
+
+    """
+
+    def __init__(self, schema, columns, length):
+        self.schema = schema
+        self.columns = columns
+        self._length = length
+        self._types = {column.name: column.data_type
+                       for column in schema.columns}
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return (SimDataRow(self, row) for row in range(self._length))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [SimDataRow(self, row)
+                    for row in range(*key.indices(self._length))]
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError("Row index out of range")
+        return SimDataRow(self, key)
+
+    def column(self, name):
+        """The array of values in column name"""
+        return self.columns[name]
+
+    def value(self, row, name):
+        """The value of column name in row, as SimDataReader would
+        decode it"""
+        value = self.columns[name][row]
+        if numpy is not None and isinstance(value, numpy.generic):
+            value = value.item()
+        data_type = self._types[name]
+        if data_type == 0:
+            return bool(value)
+        elif data_type == 1:
+            return chr(value)
+        return value
+
+    def filter(self, mask):
+        """Return a ColumnTable of just the rows for which mask, a
+        sequence with one truth value per row (e.g., a NumPy boolean
+        array), is true"""
+        if numpy is not None and all(isinstance(column, numpy.ndarray)
+                                     for column in self.columns.values()):
+            mask = numpy.asarray(mask, dtype=bool)
+            if len(mask) != self._length:
+                raise ValueError("Mask doesn't match the table's length")
+            columns = {name: column[mask]
+                       for name, column in self.columns.items()}
+            return ColumnTable(self.schema, columns, int(mask.sum()))
+        mask = [bool(x) for x in mask]
+        if len(mask) != self._length:
+            raise ValueError("Mask doesn't match the table's length")
+        columns = {name: array(column.typecode,
+                               itertools.compress(column, mask))
+                   for name, column in self.columns.items()}
+        return ColumnTable(self.schema, columns, sum(mask))
+
+class SimDataVector(list):
+    """The value of a VECTOR: a list of the elements, which also
+    records the data type and schema of the table they came from, so
+    that SimDataWriter can write them back the same way"""
+
+    def __init__(self, elements=(), data_type=None, schema=None):
+        super().__init__(elements)
+        self.data_type = data_type
+        self.schema = schema
+yaml.add_representer(SimDataVector,
+                     lambda dumper, vector: dumper.represent_list(vector))
+
+class SimDataRow:
+    """A read-only view of one row of a ColumnTable; it's indexed like
+    a SimData"""
+
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, name):
+        if name not in self.table.columns:
+            raise AttributeError("%s not found in schema" % (name,))
+        return self.table.value(self.row, name)
+
+    def __getattr__(self, name):
+        return self[name]
+
+    def __dir__(self):
+        return iter(self.table.columns)
+
+def _represent_SimDataRow(dumper, row):
+    mapping = {key: row[key] for key in row.table.columns}
+    return dumper.represent_mapping('!s4/tuning', mapping)
+yaml.add_representer(SimDataRow, _represent_SimDataRow)
+yaml.add_representer(ColumnTable,
+                     lambda dumper, table: dumper.represent_list(list(table)))
+
+class _TableList(collections.abc.Sequence):
+    """The tables of a SimDataReader, each decoded on first access"""
+
+    def __init__(self, reader):
+        self._reader = reader
+        self._tables = [None] * len(reader.tableData)
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        table = self._tables[i]
+        if table is None:
+            table = self._reader._readTable(self._reader.tableData[i])
+            self._tables[i] = table
+        return table
+
+    def decoded(self):
+        """The number of tables decoded so far"""
+        return sum(table is not None for table in self._tables)
+
+class _SimDataContent(collections.abc.Mapping):
+    """The named (single-row) tables of a SimDataReader, by name. The
+    names are known up front, but each table is only decoded when its
+    row is looked up."""
+
+    def __init__(self, tables, named):
+        self._tables = tables
+        self._named = named
+
+    def __len__(self):
+        return len(self._named)
+
+    def __iter__(self):
+        return iter(self._named)
+
+    def __contains__(self, name):
+        return name in self._named
+
+    def __getitem__(self, name):
+        return self._tables[self._named[name]][0]
+
+yaml.add_representer(_SimDataContent,
+                     lambda dumper, content: dumper.represent_dict(dict(content)))
+
 class SimDataReader(utils.BinPacker):
     _TableData = namedtuple("_TableData", "name schema data_type row_size row_pos row_count")
     _Schema = namedtuple("_Schema", "name schema_hash size columns")
     _SchemaColumn = namedtuple("_SchemaColumn", "name data_type flags offset schema_pos")
-    def __init__(self, bstr):
+    # A compiled table layout: a Struct covering a whole row, and for
+    # each column, (name, data type, index of its first field in the
+    # unpacked row, offset within the row)
+    _RowPlan = namedtuple("_RowPlan", "row_struct columns")
+    def __init__(self, bstr, columnar=False, lazy=True):
+        """If columnar is true, tables whose columns are all primitive
+        values are read into ColumnTables instead of lists of SimData
+        objects.
+
+        Only the table headers and schemas are parsed up front. If lazy
+        is true, each table is decoded the first time it's accessed
+        (through tables or content); otherwise, they're all decoded
+        here. Either way, no table is decoded more than once."""
+        if not isinstance(bstr, bytes):
+            bstr = bytes(bstr)
         super().__init__(bstr)
+        self._data = bstr
+        self._plans = {}
+        self.columnar = columnar
         if bstr[0:4] != b'DATA':
             raise FormatException("This is not a valid simdata file")
         self.off = 4
@@ -120,25 +348,24 @@ class SimDataReader(utils.BinPacker):
 
         self.off = tablePos
 
-        self.patchups = [] # A set of closures that are called with no
-                           # arguments at the end of the parse
         for _ in range(numTables):
             tableData.append(self._readTableHdr())
+        self._buildRefIndex()
 
-        self.tables = []
-        self.content = {}
-        for thdr in tableData:
-            table = self._readTable(thdr)
-            self.tables.append(table)
+        self.errors = []
+        named = collections.OrderedDict()
+        for i, thdr in enumerate(tableData):
             if thdr.name is not None:
                 if thdr.row_count != 1:
                     self.errors.append("Named table with >1 element")
-                    continue
                 else:
-                    self.content[thdr.name.decode('utf-8')] = table[0]
-        self.tables = list(map(self._readTable, tableData))
-        for patch in self.patchups:
-            patch()
+                    named[thdr.name.decode('utf-8')] = i
+
+        self.tables = _TableList(self)
+        self.content = _SimDataContent(self.tables, named)
+        if not lazy:
+            for i in range(len(tableData)):
+                self.tables[i]
 
 
     def _readTableHdr(self):
@@ -179,7 +406,184 @@ class SimDataReader(utils.BinPacker):
                 columns.append(self._SchemaColumn(cName.decode("utf-8"), cDataType, cFlags, cOffset, cSchemaPos))
         return self._Schema(name, schemaHash, schemaSize, tuple(columns)) # Tuplifying the columns results in less work for the GC
 
+    def _compileRow(self, tableData, columns):
+        """Build a _RowPlan for rows of tableData made up of columns (a
+        sequence of (name, data type, offset) triples), or return None
+        if the rows can't be decoded with a single Struct. That happens
+        if a column's position depends on where its row is (because
+        rows aren't aligned as strictly as the column's data type, so
+        _read_primitive would realign it differently in different
+        rows), or if columns overlap."""
+        fields = []
+        for name, data_type, offset in columns:
+            if data_type not in _LAYOUTS:
+                return None
+            fmt, align, _ = _LAYOUTS[data_type]
+            if tableData.row_pos % align or tableData.row_size % align:
+                return None
+            offset += -offset % align
+            fields.append((offset, struct.calcsize('<' + fmt), fmt,
+                           name, data_type))
+        fields.sort()
+        fmt = ['<']
+        plan = []
+        pos = index = 0
+        for offset, size, field_fmt, name, data_type in fields:
+            if offset < pos:
+                return None
+            if offset > pos:
+                fmt.append('%dx' % (offset - pos))
+            fmt.append(field_fmt)
+            plan.append((name, data_type, index, offset))
+            index += len(struct.unpack('<' + field_fmt, bytes(size)))
+            pos = offset + size
+        if pos > tableData.row_size:
+            return None
+        if pos < tableData.row_size:
+            fmt.append('%dx' % (tableData.row_size - pos))
+        return self._RowPlan(struct.Struct(''.join(fmt)), tuple(plan))
+
+    def _rowPlan(self, tableData):
+        if tableData.schema is None:
+            key = (tableData.data_type, tableData.row_size,
+                   tableData.row_pos % 8)
+            columns = ((None, tableData.data_type, 0),)
+        else:
+            key = (tableData.schema, tableData.row_pos % 8)
+            columns = [(column.name, column.data_type, column.offset)
+                       for column in tableData.schema.columns]
+        if key not in self._plans:
+            if tableData.row_size <= 0:
+                self._plans[key] = None
+            else:
+                self._plans[key] = self._compileRow(tableData, columns)
+        return self._plans[key]
+
+    def _string_at(self, pos):
+        end = self._data.find(b'\0', pos)
+        if end == -1 or pos < 0:
+            raise FormatException("Unexpected EOF")
+        return self._data[pos:end].decode('utf-8')
+
+    def _decodeColumn(self, data_type, rows, index, pos, stride):
+        """Decode one column from a list of unpacked rows. index is the
+        position of the column's first field in each row, and pos is
+        the file offset of the column in the first row."""
+        fmt, _, kind = _LAYOUTS[data_type]
+        if kind == 'value':
+            return [row[index] for row in rows]
+        elif kind == 'bool':
+            return [row[index] != 0 for row in rows]
+        elif kind == 'char':
+            return [chr(row[index]) for row in rows]
+        elif kind == 'tuple':
+            width = struct.calcsize('<' + fmt) // 4
+            return [row[index:index + width] for row in rows]
+        elif kind == 'tablesetref':
+            return [('tablesetref', row[index]) for row in rows]
+        elif kind == 'lockey':
+            return [('lockey', row[index]) for row in rows]
+        elif kind == 'resourcekey':
+            return [resource.ResourceID(row[index + 2], row[index],
+                                        row[index + 1])
+                    for row in rows]
+        # The rest hold offsets relative to the field itself
+        values = []
+        for row in rows:
+            rel = row[index]
+            if kind == 'string':
+                values.append(None if rel == _NULL_OFFSET
+                              else self._string_at(pos + rel))
+            elif kind == 'object':
+                values.append(None if rel == _NULL_OFFSET
+                              else self._ref_thunk(pos + rel, 1, True))
+            else:
+                count = row[index + 1]
+                if rel == _NULL_OFFSET or count == 0:
+                    values.append([])
+                else:
+                    values.append(self._ref_thunk(pos + rel, count, False))
+            pos += stride
+        return values
+
+    def _ref_thunk(self, off, count, single):
+        tbl_idx, row_slice = self.resolve_ref(off, count)
+        if single:
+            def thunk():
+                return self.tables[tbl_idx][row_slice][0]
+        else:
+            def thunk():
+                return self._vector(tbl_idx, row_slice)
+        return utils.Thunk(thunk)
+
+    def _vector(self, tbl_idx, row_slice):
+        thdr = self.tableData[tbl_idx]
+        return SimDataVector(self.tables[tbl_idx][row_slice],
+                             thdr.data_type, thdr.schema)
+
+    def _readTableCompiled(self, tableData, plan):
+        start = tableData.row_pos
+        end = start + tableData.row_size * tableData.row_count
+        rows = list(plan.row_struct.iter_unpack(
+            memoryview(self._data)[start:end]))
+        columns = []
+        for name, data_type, index, offset in plan.columns:
+            columns.append((name, self._decodeColumn(
+                data_type, rows, index, start + offset, tableData.row_size)))
+        if tableData.schema is None:
+            return columns[0][1]
+        schema = tableData.schema
+        schema_dict = {column.name: column for column in schema.columns}
+        if not columns:
+            return [SimData(schema, (), schema_dict) for _ in rows]
+        names = [name for name, _ in columns]
+        return [SimData(schema, zip(names, values), schema_dict)
+                for values in zip(*(values for _, values in columns))]
+
     def _readTable(self, tableData):
+        if tableData.schema is not None:
+            assert tableData.schema.size == tableData.row_size, "Table data and schema don't correspond with each other"
+        plan = self._rowPlan(tableData)
+        if (plan is not None and tableData.row_pos + tableData.row_size
+                * tableData.row_count <= len(self._data)):
+            if (self.columnar and tableData.schema is not None
+                    and all(column.data_type in _COLUMNAR_TYPES
+                            for column in tableData.schema.columns)):
+                return self._readTableColumnar(tableData, plan)
+            return self._readTableCompiled(tableData, plan)
+        return self._readTableSlow(tableData)
+
+    def _readTableColumnar(self, tableData, plan):
+        start = tableData.row_pos
+        count = tableData.row_count
+        columns = {}
+        if numpy is not None:
+            names = [name for name, _, _, _ in plan.columns]
+            dtype = numpy.dtype({
+                'names': names,
+                'formats': [_NUMPY_TYPES[_LAYOUTS[data_type][0]]
+                            for _, data_type, _, _ in plan.columns],
+                'offsets': [offset for _, _, _, offset in plan.columns],
+                'itemsize': tableData.row_size})
+            records = numpy.frombuffer(self._data, dtype, count, start)
+            for name, data_type, _, _ in plan.columns:
+                if data_type == 0:
+                    columns[name] = records[name] != 0
+                else:
+                    columns[name] = records[name].copy()
+        else:
+            rows = list(plan.row_struct.iter_unpack(
+                memoryview(self._data)[start:start + tableData.row_size * count]))
+            for name, data_type, index, _ in plan.columns:
+                if data_type == 0:
+                    columns[name] = array('B', (row[index] != 0
+                                                for row in rows))
+                else:
+                    columns[name] = array(_LAYOUTS[data_type][0],
+                                          (row[index] for row in rows))
+        return ColumnTable(tableData.schema, columns, count)
+
+    def _readTableSlow(self, tableData):
         content = []
         # The template assumes that the table data is all contiguous
         # immediately after the table headers. I'm not sure that
@@ -203,23 +607,48 @@ class SimDataReader(utils.BinPacker):
                 content.append(rowData)
             return content
 
-    def resolve_ref(self, pos, count):
-        for i, thdr in enumerate(self.tableData):
-            if pos >= thdr.row_pos and pos < thdr.row_pos + thdr.row_size * thdr.row_count:
-                table_no = i
-                row_idx = int((pos - thdr.row_pos) / thdr.row_size)
-                if thdr.row_count < row_idx + count:
-                    raise FormatException("Object runs off end of table")
-                if row_idx * thdr.row_size + thdr.row_pos != pos:
-                    raise FormatException("Unaligned read of an object")
-                return (i, slice(row_idx, row_idx+count))
-        else:
+    def _buildRefIndex(self):
+        """Sort the tables' row ranges, so that resolve_ref can find the
+        table containing an offset by bisection. If any ranges overlap,
+        resolve_ref has to search the tables in order instead."""
+        ranges = sorted(
+            (thdr.row_pos, thdr.row_pos + thdr.row_size * thdr.row_count, i)
+            for i, thdr in enumerate(self.tableData)
+            if thdr.row_pos is not None and thdr.row_size * thdr.row_count > 0)
+        for (_, end, _), (start, _, _) in zip(ranges, ranges[1:]):
+            if start < end:
+                self._ref_ranges = self._ref_starts = None
+                return
+        self._ref_ranges = ranges
+        self._ref_starts = [start for start, _, _ in ranges]
+
+    def _findTable(self, pos):
+        if self._ref_starts is None:
+            for i, thdr in enumerate(self.tableData):
+                if pos >= thdr.row_pos and pos < thdr.row_pos + thdr.row_size * thdr.row_count:
+                    return i
             raise FormatException("Object not in a table")
+        k = bisect.bisect_right(self._ref_starts, pos) - 1
+        if k < 0 or pos >= self._ref_ranges[k][1]:
+            raise FormatException("Object not in a table")
+        return self._ref_ranges[k][2]
+
+    def resolve_ref(self, pos, count):
+        """Find the count rows starting at offset pos. Returns the table
+        number and a slice of its rows."""
+        i = self._findTable(pos)
+        thdr = self.tableData[i]
+        row_idx = (pos - thdr.row_pos) // thdr.row_size
+        if thdr.row_count < row_idx + count:
+            raise FormatException("Object runs off end of table")
+        if row_idx * thdr.row_size + thdr.row_pos != pos:
+            raise FormatException("Unaligned read of an object")
+        return (i, slice(row_idx, row_idx+count))
 
     def _read_primitive(self, datatype):
         if datatype == 0: # BOOL
             # Boolean
-            return self.get_int8() == 0
+            return self.get_int8() != 0
         elif datatype == 1: # CHAR8
             return chr(self.get_uint8())
         elif datatype == 2: # INT8
@@ -273,7 +702,7 @@ class SimDataReader(utils.BinPacker):
             else:
                 tbl_idx, row_slice = self.resolve_ref(off, count)
                 def thunk():
-                    return self.tables[tbl_idx][row_slice]
+                    return self._vector(tbl_idx, row_slice)
                 return utils.Thunk(thunk)
         elif datatype == 15:    # FLOAT2
             self.align(4)
@@ -304,3 +733,362 @@ class SimDataReader(utils.BinPacker):
             # TODO: Figure out if type 21 is used anywhere, and if so,
             # reverse it.
             raise FormatException("Unknown resource type %d" % (datatype,))
+
+# Data types whose values point at other tables
+_REFERENCE_TYPES = frozenset((13, 14))
+# Data types whose values point into the string pool
+_STRING_TYPES = frozenset((11, 12))
+
+def _row_schema(value):
+    """The schema of a SimData or SimDataRow, or None for anything
+    else"""
+    if isinstance(value, SimData):
+        return object.__getattribute__(value, 'schema')
+    if isinstance(value, SimDataRow):
+        return value.table.schema
+    return None
+
+def _row_identity(value):
+    # SimDataRows are created on each access, so two of them are the
+    # same row if they view the same row of the same table
+    if isinstance(value, SimDataRow):
+        return (id(value.table), value.row)
+    return id(value)
+
+def _guess_type(elements):
+    """Guess the data type of the elements of a plain list"""
+    first = elements[0]
+    if isinstance(first, bool):
+        return 0
+    elif isinstance(first, int):
+        if all(-0x80000000 <= x < 0x80000000 for x in elements):
+            return 6
+        if all(x >= 0 for x in elements):
+            return 9
+        return 8
+    elif isinstance(first, float):
+        return 10
+    elif isinstance(first, str):
+        return 11
+    elif isinstance(first, resource.ResourceID):
+        return 19
+    elif isinstance(first, list):
+        return 14
+    elif isinstance(first, tuple) and first and first[0] == 'tablesetref':
+        return 18
+    elif isinstance(first, tuple) and first and first[0] == 'lockey':
+        return 20
+    elif isinstance(first, tuple) and 2 <= len(first) <= 4:
+        return 13 + len(first)
+    raise TypeError("Can't tell how to store %r in SimData" % (first,))
+
+class _OutTable:
+    """A table being assembled by SimDataWriter"""
+    def __init__(self, name, schema, data_type):
+        self.name = name
+        self.schema = schema
+        self.data_type = data_type
+        if schema is not None:
+            self.row_size = schema.size
+        else:
+            self.row_size = struct.calcsize('<' + _LAYOUTS[data_type][0])
+        self.rows = []
+        self.row_pos = None
+
+class SimDataWriter:
+    """Serializes SimData object graphs into the DATA format that
+    SimDataReader reads.
+
+    content maps table names to SimData (or SimDataRow) objects, like
+    SimDataReader.content. Each becomes a named, single-row table;
+    everything they refer to is packed into unnamed tables, one per
+    schema or element type. A row that is referred to more than once
+    is only stored once (unless it's part of more than one VECTOR, as
+    the elements of a VECTOR have to be contiguous), as are identical
+    vectors of primitive values and identical strings.
+
+    VECTOR values read by SimDataReader remember their element type;
+    for plain lists, it's guessed from the elements.
+
+    """
+
+    def __init__(self, content, version=0x101):
+        self.version = version
+        self._tables = []
+        self._unnamed = {}
+        self._slots = {}     # row identity -> (table, row number)
+        self._vectors = {}   # vector key -> (table, first row)
+        self._vector_keys = {}  # id(vector) -> vector key
+        self._strings = {}   # bytes -> offset in the string pool
+        self._values = {}    # row identity -> the row's column values
+        self._keep = []      # Keeps rows alive, so that ids stay unique
+        self._pending = collections.deque()
+        self._schema_refs = {}
+
+        for name, row in content.items():
+            schema = _row_schema(row)
+            if schema is None:
+                raise TypeError("Table %s isn't a SimData row" % (name,))
+            table = _OutTable(name.encode('utf-8'), schema, 13)
+            self._tables.append(table)
+            self._add_row(table, row)
+        while self._pending:
+            self._visit(self._pending.popleft())
+
+        self._schemas = list(dict.fromkeys(
+            table.schema for table in self._tables
+            if table.schema is not None))
+
+    def _table_for(self, schema, data_type):
+        key = schema if schema is not None else data_type
+        if key not in self._unnamed:
+            table = _OutTable(None, schema, data_type)
+            self._unnamed[key] = table
+            self._tables.append(table)
+        return self._unnamed[key]
+
+    def _add_row(self, table, row):
+        # Append row to table; the first place a row is stored is the
+        # one that OBJECTs referring to it point at
+        identity = _row_identity(row)
+        table.rows.append(identity)
+        if identity not in self._slots:
+            self._slots[identity] = (table, len(table.rows) - 1)
+            self._keep.append(row)
+            self._pending.append(row)
+
+    def _visit(self, row):
+        schema = _row_schema(row)
+        values = [row[column.name] for column in schema.columns]
+        self._values[_row_identity(row)] = values
+        for column, value in zip(schema.columns, values):
+            if column.data_type in _REFERENCE_TYPES and value:
+                target = self._add_reference(column.data_type, value)
+                if target is not None:
+                    self._schema_refs.setdefault((schema, column.name),
+                                                 target)
+            elif column.data_type in _STRING_TYPES and value is not None:
+                self._add_string(value.encode('utf-8'))
+
+    def _add_string(self, bstr):
+        self._strings.setdefault(bstr, None)
+
+    def _add_reference(self, data_type, value):
+        """Make sure that whatever value (of data type OBJECT or VECTOR)
+        points at is stored, and return the schema of its rows, if
+        they have one"""
+        if data_type == 13:
+            schema = _row_schema(value)
+            if schema is None:
+                raise TypeError("OBJECT value %r isn't a SimData row" % (value,))
+            if _row_identity(value) not in self._slots:
+                self._add_row(self._table_for(schema, 13), value)
+            return schema
+        return self._add_vector(value)
+
+    def _add_vector(self, vector):
+        # Elements of a schema-less table of OBJECTs come out of
+        # SimDataReader as thunks
+        elements = [element.value if isinstance(element, utils.Thunk)
+                    else element for element in vector]
+        schema = getattr(vector, 'schema', None)
+        data_type = getattr(vector, 'data_type', None)
+        if any(_row_schema(element) is not None for element in elements):
+            if schema is None and data_type == 13:
+                # A table of OBJECTs, rather than a table of rows
+                key = ('objects',)
+            else:
+                key = ('rows',)
+                schema = _row_schema(elements[0])
+                if data_type is None:
+                    data_type = 13
+            key += tuple(map(_row_identity, elements))
+        else:
+            if data_type is None or schema is not None:
+                data_type = _guess_type(elements)
+            schema = None
+            if data_type == 14:
+                key = ('values', 14) + tuple(map(id, elements))
+            else:
+                key = ('values', data_type) + tuple(elements)
+        self._vector_keys[id(vector)] = key
+        self._keep.append(vector)
+        if key in self._vectors:
+            return schema
+
+        if schema is not None:
+            table = self._table_for(schema, data_type)
+            self._vectors[key] = (table, len(table.rows))
+            for row in elements:
+                if _row_schema(row) != schema:
+                    raise TypeError("VECTOR elements have different schemas")
+                self._add_row(table, row)
+            return schema
+
+        table = self._table_for(None, data_type)
+        self._vectors[key] = (table, len(table.rows))
+        table.rows.extend(elements)
+        for element in elements:
+            if data_type in _REFERENCE_TYPES and element:
+                self._add_reference(data_type, element)
+            elif data_type in _STRING_TYPES and element is not None:
+                self._add_string(element.encode('utf-8'))
+        return None
+
+    def _layout(self):
+        """Assign every header, table, and string its position, and
+        return the total size of the output"""
+        names = [table.name for table in self._tables if table.name]
+        names.extend(schema.name for schema in self._schemas if schema.name)
+        names.extend(column.name.encode('utf-8')
+                     for schema in self._schemas
+                     for column in schema.columns)
+        for name in names:
+            self._add_string(name)
+
+        pos = 24
+        self._table_pos = pos
+        pos += 28 * len(self._tables)
+        self._schema_pos = {}
+        schemas_start = pos
+        pos += 24 * len(self._schemas)
+        for schema in self._schemas:
+            self._schema_pos[schema] = schemas_start
+            schemas_start += 24
+        self._columns_pos = {}
+        for schema in self._schemas:
+            self._columns_pos[schema] = pos
+            pos += 20 * len(schema.columns)
+        for table in self._tables:
+            pos += -pos % 16
+            table.row_pos = pos
+            pos += table.row_size * len(table.rows)
+        for bstr in self._strings:
+            self._strings[bstr] = pos
+            pos += len(bstr) + 1
+        return pos
+
+    def write(self):
+        """Return the serialized SimData, as bytes"""
+        size = self._layout()
+        buf = bytearray(size)
+        self._buf = buf
+        hashes = fnv1.fnv1_bulk(
+            [(name or b"").lower() for name in itertools.chain(
+                (table.name for table in self._tables),
+                (schema.name for schema in self._schemas),
+                (column.name.encode('utf-8') for schema in self._schemas
+                 for column in schema.columns),
+                self._strings)], 32)
+        self._hashes = hashes
+
+        struct.pack_into('<4sI', buf, 0, b'DATA', self.version)
+        self._put_off(8, self._table_pos)
+        struct.pack_into('<i', buf, 12, len(self._tables))
+        self._put_off(16, self._schema_pos[self._schemas[0]]
+                      if self._schemas else None)
+        struct.pack_into('<i', buf, 20, len(self._schemas))
+
+        for i, table in enumerate(self._tables):
+            pos = self._table_pos + 28 * i
+            self._put_string(pos, table.name)
+            struct.pack_into('<I', buf, pos + 4, hashes[(table.name or b"").lower()])
+            self._put_off(pos + 8, self._schema_pos.get(table.schema))
+            struct.pack_into('<II', buf, pos + 12, table.data_type,
+                             table.row_size)
+            self._put_off(pos + 20, table.row_pos)
+            struct.pack_into('<I', buf, pos + 24, len(table.rows))
+
+        for schema in self._schemas:
+            pos = self._schema_pos[schema]
+            self._put_string(pos, schema.name)
+            struct.pack_into('<III', buf, pos + 4,
+                             hashes[(schema.name or b"").lower()],
+                             schema.schema_hash, schema.size)
+            self._put_off(pos + 16, self._columns_pos[schema])
+            struct.pack_into('<I', buf, pos + 20, len(schema.columns))
+            for j, column in enumerate(schema.columns):
+                cpos = self._columns_pos[schema] + 20 * j
+                name = column.name.encode('utf-8')
+                self._put_string(cpos, name)
+                struct.pack_into('<IHHI', buf, cpos + 4, hashes[name.lower()],
+                                 column.data_type, column.flags, column.offset)
+                self._put_off(cpos + 16, self._schema_pos.get(
+                    self._schema_refs.get((schema, column.name))))
+
+        for table in self._tables:
+            self._write_rows(table)
+
+        for bstr, pos in self._strings.items():
+            buf[pos:pos + len(bstr)] = bstr
+        del self._buf
+        return bytes(buf)
+
+    def _put_off(self, pos, target):
+        struct.pack_into('<i', self._buf, pos,
+                         _NULL_OFFSET if target is None else target - pos)
+
+    def _put_string(self, pos, bstr):
+        self._put_off(pos, None if bstr is None else self._strings[bstr])
+
+    def _write_rows(self, table):
+        if table.schema is not None:
+            columns = [(column.data_type, column.offset)
+                       for column in table.schema.columns]
+            rows = map(self._values.__getitem__, table.rows)
+        else:
+            columns = [(table.data_type, 0)]
+            rows = ((value,) for value in table.rows)
+        packers = []
+        for data_type, offset in columns:
+            fmt, align, _ = _LAYOUTS[data_type]
+            packers.append((data_type, 2 <= data_type <= 10, offset, align,
+                            struct.Struct('<' + fmt).pack_into))
+        buf = self._buf
+        base = table.row_pos
+        for values in rows:
+            for (data_type, simple, offset, align, pack_into), value in zip(
+                    packers, values):
+                # Where _read_primitive would find the value
+                pos = base + offset
+                pos += -pos % align
+                if simple:
+                    pack_into(buf, pos, value)
+                else:
+                    pack_into(buf, pos, *self._fields(data_type, value, pos))
+            base += table.row_size
+
+    def _fields(self, data_type, value, pos):
+        """The struct fields that store value, at offset pos"""
+        if data_type == 0:
+            return (1 if value else 0,)
+        elif data_type == 1:
+            return (ord(value),)
+        elif data_type <= 10:
+            return (value,)
+        elif data_type in _STRING_TYPES:
+            if value is None:
+                rel = _NULL_OFFSET
+            else:
+                bstr = value.encode('utf-8')
+                rel = self._strings[bstr] - pos
+            if data_type == 11:
+                return (rel,)
+            return (rel, self._hashes[bstr.lower()] if value is not None else 0)
+        elif data_type == 13:
+            if value is None:
+                return (_NULL_OFFSET,)
+            table, row = self._slots[_row_identity(value)]
+            return (table.row_pos + table.row_size * row - pos,)
+        elif data_type == 14:
+            if not value:
+                return (_NULL_OFFSET, 0)
+            table, row = self._vectors[self._vector_keys[id(value)]]
+            return (table.row_pos + table.row_size * row - pos, len(value))
+        elif data_type <= 17:
+            return tuple(value)
+        elif data_type in (18, 20):
+            return (value[1] if isinstance(value, tuple) else value,)
+        elif data_type == 19:
+            return (value.instance, value.type, value.group)
+        raise FormatException("Unknown data type %d" % (data_type,))
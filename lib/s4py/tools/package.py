@@ -1,39 +1,61 @@
 import click
-import os
-import os.path
+import shutil
 import sys
 from .. import inspect
 from .. import package
+from ..package import dbpf
 from .. import tools
-from ..resource import ResourceID, ResourceFilter
+from ..resource import ResourceID, ResourceFilter, ValueSet, SetFilter, \
+    NotFilter, compile_filters
 
 @tools.main.group(name="package")
 def pkg():
     pass
 
-class AnyFilter:
-    def __init__(self, filters):
-        self.filters = list(filters)
-    def add(self, filter):
-        self.filters.append(filter)
-        return self
-    def match(self, target):
-        for filter in self.filters:
-            if filter.match(target):
-                return True
-        return False
-    def __str__(self):
-        return "(%s)" % (" | ".join(str(x) for x in self.filters))
+def read_trace(f):
+    """Read an access trace: a file with one resource ID per line"""
+    return [ResourceID.from_string(line.strip())
+            for line in f if line.strip()]
+
+def parseField(s):
+    """Parse one field of a filter: blank for any value, or a
+    comma-separated list of hex values and inclusive low-high
+    ranges. Returns None, an int, or a ValueSet."""
+    if not s:
+        return None
+    values = []
+    ranges = []
+    for item in s.split(','):
+        low, sep, high = item.partition('-')
+        if sep:
+            low, high = int(low, 16), int(high, 16)
+            if low > high:
+                raise ValueError("Empty range %s" % (item,))
+            ranges.append((low, high))
+        else:
+            values.append(int(item, 16))
+    if len(values) == 1 and not ranges:
+        return values[0]
+    return ValueSet(values, ranges)
 
 def parseFilter(s):
     """Parse a filter from a string. The format is
-    <group>:<instance>:<type> where any of the fields can be blank.
+    [!]<group>:<instance>:<type> where any of the fields can be blank.
     Group, instance, and type are specified as hex strings; leading
-    0's and the initial 0x are optional."""
+    0's and the initial 0x are optional. Each field may also be a
+    comma-separated list of values and low-high ranges, e.g.
+    ::545ac67a,6017e896 or :0-ffff:. A leading ! excludes the
+    resources that the rest of the filter matches."""
 
     # TODO: replace with regexes derived from those in resource.py
-    group,instance,type = [int(_, 16) if _ else None
-                           for _ in s.split(':', 3)]
+    if s.startswith('!!'):
+        return parseFilter(s[2:])
+    if s.startswith('!'):
+        return NotFilter(parseFilter(s[1:]))
+    group,instance,type = [parseField(_) for _ in s.split(':', 3)]
+    fields = (group, instance, type)
+    if any(isinstance(f, ValueSet) for f in fields):
+        return SetFilter(group, instance, type)
     if group is not None and instance is not None and type is not None:
         # ResourceID's match function is somewhat faster than
         # ResourceFilter's match function, so we have this small
@@ -41,6 +63,18 @@ def parseFilter(s):
         return ResourceID(group, instance, type)
     return ResourceFilter(group, instance, type)
 
+def parseFilters(strings):
+    """Parse and compile a list of --filter arguments. Returns None
+    when there are none."""
+    return compile_filters(parseFilter(s) for s in strings)
+
+# The --filter option shared by every command that takes filters; see
+# parseFilters
+filter_option = click.option(
+    "--filter", multiple=True, metavar="[!]G:I:T",
+    help="""Only include matching resources. Fields are hex """
+    """values, comma-separated lists, or low-high ranges; """
+    """a leading ! excludes resources instead.""")
 
 @pkg.command()
 @click.option("--decode", "-d", is_flag=True,
@@ -57,47 +91,144 @@ def cat(pkg, item, type, decode):
     """Extract items matching ITEM from PACKAGE"""
     rid = ResourceID.from_string(item)
     dbfile = package.open_package(pkg, mode="r")
+    if not decode:
+        with dbfile[rid].open() as content:
+            shutil.copyfileobj(content, sys.stdout.buffer)
+        return
     content = dbfile[rid].content
-    if decode:
-        if type is None:
-            type = rid.type
-        else:
-            try:
-                type = int(type, 16)
-            except ValueError:
-                pass
-        inspector = inspect.find_inspector(type)(content)
-        inspector.pprint(sys.stdout)
+    if type is None:
+        type = rid.type
     else:
-        sys.stdout.buffer.write(content)
+        try:
+            type = int(type, 16)
+        except ValueError:
+            pass
+    inspector = inspect.find_inspector(type)(content)
+    inspector.pprint(sys.stdout)
 
 @pkg.command(help="Convert between package formats")
-@click.option("--filter", multiple=True)
+@filter_option
 @click.option('-o','--out', help="Output directory", default="gen")
+@click.option("--compression",
+              type=click.Choice(sorted(dbpf.COMPRESSORS)),
+              help="""Compression method for .package output (default """
+              """zlib)""")
+@click.option("--level", type=int,
+              help="zlib compression level")
+@click.option("--store-type", multiple=True, metavar="TYPE",
+              help="Store resources of this (hex) type uncompressed")
+@click.option("--min-size", type=int,
+              help="Store resources smaller than this uncompressed")
+@click.option("--jobs", "-j", default=1, type=int,
+              help="Number of threads to compress with")
+@click.option("--recompress", is_flag=True,
+              help="""Recompress resources even when converting from """
+              """one .package to another (by default, their """
+              """compressed data is copied as-is). Implied by any of """
+              """the compression options.""")
+@click.option("--dedup", is_flag=True,
+              help="Store resources with identical content only once")
+@click.option("--layout", type=click.Choice(sorted(dbpf.LAYOUTS)),
+              help="Order resources in the output by type or instance")
+@click.option("--trace", type=click.File("r"),
+              help="""A file listing resource IDs, one per line, in """
+              """the order they are usually read. These resources """
+              """are placed first.""")
 @click.argument("file", metavar="PKG", type=click.Path(exists=True,
                                                        readable=True))
-def convert(file, filter, out):
-    if filter:
-        filters = AnyFilter(parseFilter(f) for f in filter)
-    else:
-        filters = None
+def convert(file, filter, out, compression, level, store_type, min_size,
+            jobs, recompress, dedup, layout, trace):
+    filters = parseFilters(filter)
     dbfile = package.open_package(file, mode="r")
-    outpkg = package.open_package(out, mode="w")
-    for rid in dbfile.scan_index(filters):
-        print(rid.as_filename())
-        outpkg.put(rid, dbfile[rid].content)
+    # Copying compressed data as-is would ignore these
+    if (compression is not None or level is not None or store_type
+            or min_size is not None):
+        recompress = True
+    policy = dbpf.CompressionPolicy(
+        compression or "zlib",
+        level=-1 if level is None else level,
+        type_methods={int(t, 16): 'none' for t in store_type},
+        min_size=min_size or 0)
+    outpkg = package.open_package(out, mode="w", compression=policy,
+                                  jobs=jobs, dedup=dedup)
+    if trace is not None:
+        layout = read_trace(trace)
+    rids = dbpf.layout_order(dbfile.scan_index(filters), layout)
+    if (not recompress and isinstance(dbfile, dbpf.DbpfPackage)
+            and isinstance(outpkg, dbpf.DbpfPackage)):
+        for rid in rids:
+            print(rid.as_filename())
+        outpkg.copy_from(dbfile, rids, keep_order=layout is not None)
+    else:
+        for rid in rids:
+            print(rid.as_filename())
+            item = dbfile[rid]
+            with item.open() as content:
+                outpkg.put_stream(rid, content, item.size)
     outpkg.commit()
+    if dedup and isinstance(outpkg, dbpf.DbpfPackage):
+        print("Deduplication saved %d bytes" % (outpkg.dedup_saved,),
+              file=sys.stderr)
+
+@pkg.command(help="Rewrite a .package file without dead space")
+@click.option("--order", default="file",
+              type=click.Choice(("file",) + tuple(sorted(dbpf.LAYOUTS))),
+              help="""Keep resources in their current order, or """
+              """order them by type or instance""")
+@click.option("--trace", type=click.File("r"),
+              help="""A file listing resource IDs, one per line, in """
+              """the order they are usually read. These resources """
+              """are placed first.""")
+@click.argument("file", metavar="PKG", type=click.Path(exists=True,
+                                                       readable=True,
+                                                       writable=True))
+def compact(file, order, trace):
+    dbfile = dbpf.DbpfPackage(file, "a")
+    if trace is not None:
+        order = read_trace(trace)
+    elif order == "file":
+        order = None
+    reclaimed = dbfile.compact(order)
+    dbfile.close()
+    print("Reclaimed %d bytes" % (reclaimed,))
+
+def describe_package(pkg):
+    """A short, human-readable name for a package"""
+    for attr in ("name", "path"):
+        name = getattr(pkg, attr, None)
+        if name is not None:
+            return name
+    return repr(pkg)
+
+@pkg.command(help="""Show resources that are provided by more than one """
+             """package in a stack. PKGS is either a single .meta file """
+             """or a list of packages, lowest priority first.""")
+@filter_option
+@click.argument("files", metavar="PKGS", nargs=-1, required=True,
+                type=click.Path(exists=True, readable=True))
+def conflicts(files, filter):
+    filters = parseFilters(filter)
+    if len(files) == 1:
+        stack = package.open_package(files[0], mode="r")
+        if not isinstance(stack, package.MetaPackage):
+            stack = package.MetaPackage([stack], lazy=True)
+    else:
+        stack = package.MetaPackage(
+            [package.open_package(f, mode="r") for f in files], lazy=True)
+    for conflict in stack.conflicts(filters):
+        print("{id:34s} {winner} shadows {shadowed}".format(
+            id=str(conflict.id),
+            winner=describe_package(conflict.winner),
+            shadowed=", ".join(describe_package(p)
+                               for p in conflict.shadowed)))
 
 @pkg.command(help="list files in a package")
-@click.option("--filter", multiple=True)
+@filter_option
 @click.option("--long", "-l", is_flag=True)
 @click.argument("file", metavar="PKG", type=click.Path(exists=True,
                                                        readable=True))
 def ls(file, filter, long):
-    if filter:
-        filters = AnyFilter(parseFilter(f) for f in filter)
-    else:
-        filters = None
+    filters = parseFilters(filter)
     dbfile = package.open_package(file, mode="r")
     for entry in dbfile.scan_index(filters):
         idx = dbfile[entry]
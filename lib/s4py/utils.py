@@ -71,7 +71,7 @@ class BinPacker:
     def __init__(self, bstr, mode="r"):
         if mode == 'w':
             self.writable = True
-        if isinstance(bstr, bytes):
+        if isinstance(bstr, (bytes, bytearray, memoryview)):
             self.raw_len = len(bstr)
             bstr = io.BytesIO(bstr)
         else:
@@ -13,6 +13,10 @@ setup(
     packages = find_packages("lib"),
     package_dir = {'': 'lib'},
     install_requires = ['Click', 'PyYAML'],
+    extras_require = {
+        # Faster columnar SimData tables
+        'numpy': ['numpy'],
+    },
     entry_points = {
         'console_scripts': [
             # This way, you can also use python -ms4py
@@ -0,0 +1,24 @@
+# Run the tests against the source tree, without installing it first
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "lib"))
+
+# Timing comparisons are too noisy for an ordinary test run; they only
+# run when S4PY_BENCHMARK is set in the environment, e.g.
+#   S4PY_BENCHMARK=1 python -m pytest -s -m benchmark tests
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: timing test, run only if S4PY_BENCHMARK is set")
+
+def pytest_collection_modifyitems(config, items):
+    if os.environ.get("S4PY_BENCHMARK"):
+        return
+    skip = pytest.mark.skip(reason="set S4PY_BENCHMARK to run benchmarks")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
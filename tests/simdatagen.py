@@ -0,0 +1,223 @@
+# Build SimData (DATA) resources byte by byte, independently of the
+# writer in s4py.simdata, so that the reader can be tested on layouts
+# the writer would never produce.
+
+import struct
+
+from s4py import fnv1
+
+NULL_OFFSET = -0x80000000
+
+def name_hash(name):
+    return fnv1.fnv1((name or b"").lower(), 32)
+
+def build(schemas, tables):
+    """Return the bytes of a SimData resource.
+
+    schemas is a list of (name, size, columns) tuples, where columns is
+    a list of (name, data type, offset) tuples.
+
+    tables is a list of dicts with keys name (bytes or None), schema
+    (an index into schemas, or None), dtype, row_size, and rows. Each
+    row is a list of (offset, kind, value) cells, where kind is a
+    struct format, or one of:
+
+      'str'  -- value is a string (bytes) or None
+      'hstr' -- value is a string, stored with its hash
+      'ref'  -- value is (table, row), or None
+      'vec'  -- value is (table, first row, count)
+
+    Instead of rows, a table may have alias = (table, row), in which
+    case its rows are the row_count rows starting at that row of the
+    other table; this makes tables overlap.
+
+    """
+    buf = bytearray(24)
+    fixups = []   # (field position, target)
+    table_pos = len(buf)
+    buf += bytes(28 * len(tables))
+    schema_pos = len(buf)
+    buf += bytes(24 * len(schemas))
+    column_pos = []
+    for _, _, columns in schemas:
+        column_pos.append(len(buf))
+        buf += bytes(20 * len(columns))
+    row_pos = []
+    for table in tables:
+        while len(buf) % 16:
+            buf.append(0)
+        row_pos.append(len(buf))
+        if 'alias' not in table:
+            buf += bytes(table['row_size'] * len(table['rows']))
+
+    struct.pack_into('<4sI', buf, 0, b'DATA', 0x101)
+    fixups.append((8, ('pos', table_pos)))
+    struct.pack_into('<i', buf, 12, len(tables))
+    fixups.append((16, ('pos', schema_pos)))
+    struct.pack_into('<i', buf, 20, len(schemas))
+    for i, (name, size, columns) in enumerate(schemas):
+        pos = schema_pos + 24 * i
+        fixups.append((pos, ('str', name)))
+        struct.pack_into('<III', buf, pos + 4, name_hash(name), 0x1234 + i,
+                         size)
+        fixups.append((pos + 16, ('pos', column_pos[i])))
+        struct.pack_into('<I', buf, pos + 20, len(columns))
+        for j, (cname, dtype, offset) in enumerate(columns):
+            cpos = column_pos[i] + 20 * j
+            fixups.append((cpos, ('str', cname)))
+            struct.pack_into('<IHHI', buf, cpos + 4, name_hash(cname), dtype,
+                             0, offset)
+            fixups.append((cpos + 16, None))
+
+    def rows_at(ti, row):
+        table = tables[ti]
+        if 'alias' in table:
+            ti, first = table['alias']
+            return rows_at(ti, first + row)
+        return row_pos[ti] + row * table['row_size']
+
+    for i, table in enumerate(tables):
+        pos = table_pos + 28 * i
+        fixups.append((pos, ('str', table['name']) if table['name'] else None))
+        struct.pack_into('<I', buf, pos + 4, name_hash(table['name']))
+        if table['schema'] is None:
+            fixups.append((pos + 8, None))
+        else:
+            fixups.append((pos + 8, ('pos', schema_pos + 24 * table['schema'])))
+        struct.pack_into('<II', buf, pos + 12, table['dtype'],
+                         table['row_size'])
+        if 'alias' in table:
+            fixups.append((pos + 20, ('row',) + table['alias']))
+            struct.pack_into('<I', buf, pos + 24, table['row_count'])
+            continue
+        fixups.append((pos + 20, ('pos', row_pos[i])))
+        struct.pack_into('<I', buf, pos + 24, len(table['rows']))
+        for r, cells in enumerate(table['rows']):
+            base = row_pos[i] + r * table['row_size']
+            for offset, kind, value in cells:
+                if kind == 'str':
+                    fixups.append((base + offset,
+                                   None if value is None else ('str', value)))
+                elif kind == 'hstr':
+                    fixups.append((base + offset, ('str', value)))
+                    struct.pack_into('<I', buf, base + offset + 4,
+                                     name_hash(value))
+                elif kind == 'ref':
+                    fixups.append((base + offset,
+                                   None if value is None else ('row',) + value))
+                elif kind == 'vec':
+                    fixups.append((base + offset,
+                                   ('row',) + value[:2] if value[2] else None))
+                    struct.pack_into('<I', buf, base + offset + 4, value[2])
+                else:
+                    if not isinstance(value, tuple):
+                        value = (value,)
+                    struct.pack_into('<' + kind, buf, base + offset, *value)
+
+    strings = {}
+    for pos, target in fixups:
+        if target is None:
+            struct.pack_into('<i', buf, pos, NULL_OFFSET)
+            continue
+        if target[0] == 'str':
+            if target[1] not in strings:
+                strings[target[1]] = len(buf)
+                buf += target[1] + b'\0'
+            dest = strings[target[1]]
+        elif target[0] == 'pos':
+            dest = target[1]
+        else:
+            dest = rows_at(target[1], target[2])
+        struct.pack_into('<i', buf, pos, dest - pos)
+    return bytes(buf)
+
+def linked_tables(ntables, rnd):
+    """A SimData resource with ntables small tables of Node rows, each
+    of which refers to a random row and a vector of rows elsewhere."""
+    schemas = [(b'Node', 16, [(b'val', 7, 0), (b'next', 13, 4),
+                              (b'kids', 14, 8)])]
+    sizes = [rnd.randrange(1, 4) for _ in range(ntables)]
+    tables = []
+    for size in sizes:
+        rows = []
+        for _ in range(size):
+            target = rnd.randrange(ntables)
+            rows.append([(0, 'I', rnd.getrandbits(32)),
+                         (4, 'ref', (rnd.randrange(ntables), 0)),
+                         (8, 'vec', (target, 0,
+                                     rnd.randrange(sizes[target] + 1)))])
+        tables.append(dict(name=None, schema=0, dtype=0, row_size=16,
+                           rows=rows))
+    return build(schemas, tables)
+
+# A column of every data type, at offsets that respect each type's
+# alignment
+ROW_COLUMNS = [
+    (b'flag', 0, 0), (b'letter', 1, 1), (b'tiny', 2, 2), (b'utiny', 3, 3),
+    (b'small', 4, 4), (b'usmall', 5, 6), (b'int', 6, 8), (b'count', 7, 12),
+    (b'big', 8, 16), (b'ubig', 9, 24), (b'ratio', 10, 32),
+    (b'label', 11, 36), (b'hlabel', 12, 40), (b'link', 13, 48),
+    (b'items', 14, 52), (b'uv', 15, 60), (b'pos', 16, 68),
+    (b'colour', 17, 80), (b'tset', 18, 96), (b'key', 19, 104),
+    (b'loc', 20, 120),
+]
+
+TOP_COLUMNS = [
+    (b'rows', 14, 0), (b'names', 14, 8), (b'empty', 14, 16),
+    (b'objs', 14, 24), (b'nested', 14, 32),
+]
+
+def sample(nrows, rnd, nulls=False):
+    """A SimData resource using every data type. A named table, Top,
+    has vectors of nrows rows of every type (which link to each other
+    at random, cycles and all), of strings, of a schema-less table of
+    OBJECTs, and of vectors, plus an empty vector."""
+    def real():
+        # Exactly representable as a 32-bit float
+        return rnd.randrange(-4000, 4000) / 8
+
+    schemas = [(b'Row', 128, ROW_COLUMNS), (b'Top', 40, TOP_COLUMNS)]
+    nints = 50
+    ints = dict(name=None, schema=None, dtype=7, row_size=4,
+                rows=[[(0, 'I', rnd.getrandbits(32))] for _ in range(nints)])
+    strs = dict(name=None, schema=None, dtype=11, row_size=4,
+                rows=[[(0, 'str', b'str%d' % i)] for i in range(10)])
+    rows = []
+    for i in range(nrows):
+        count = rnd.randrange(5)
+        first = rnd.randrange(nints - count + 1)
+        link = rnd.randrange(nrows)
+        rows.append([
+            (0, 'b', rnd.choice((0, 1))), (1, 'B', rnd.randrange(32, 127)),
+            (2, 'b', rnd.randrange(-128, 128)), (3, 'B', rnd.randrange(256)),
+            (4, 'h', rnd.randrange(-30000, 30000)),
+            (6, 'H', rnd.randrange(65536)),
+            (8, 'i', rnd.getrandbits(32) - (1 << 31)),
+            (12, 'I', rnd.getrandbits(32)),
+            (16, 'q', rnd.getrandbits(64) - (1 << 63)),
+            (24, 'Q', rnd.getrandbits(64)), (32, 'f', real()),
+            (36, 'str', rnd.choice((None if nulls else b'x', b'abc',
+                                    b'label%d' % i))),
+            (40, 'hstr', b'h%d' % (i % 7)),
+            (48, 'ref', None if nulls and link % 3 == 0 else (2, link)),
+            (52, 'vec', (0, first, count)),
+            (60, '2f', (real(), real())),
+            (68, '3f', (real(), real(), real())),
+            (80, '4f', (real(), real(), real(), real())),
+            (96, 'Q', rnd.getrandbits(64)),
+            (104, 'QII', (rnd.getrandbits(64), rnd.getrandbits(32),
+                          rnd.getrandbits(32))),
+            (120, 'I', rnd.getrandbits(32)),
+        ])
+    table = dict(name=None, schema=0, dtype=0, row_size=128, rows=rows)
+    # Points at some rows more than once
+    objs = dict(name=None, schema=None, dtype=13, row_size=4,
+                rows=[[(0, 'ref', (2, rnd.randrange(nrows)))]
+                      for _ in range(6)])
+    vecs = dict(name=None, schema=None, dtype=14, row_size=8,
+                rows=[[(0, 'vec', (0, 0, 3))], [(0, 'vec', (0, 3, 4))]])
+    top = dict(name=b'Top', schema=1, dtype=0, row_size=40,
+               rows=[[(0, 'vec', (2, 0, nrows)), (8, 'vec', (1, 0, 10)),
+                      (16, 'vec', (0, 0, 0)), (24, 'vec', (3, 0, 6)),
+                      (32, 'vec', (4, 0, 2))]])
+    return build(schemas, [ints, strs, table, objs, vecs, top])
@@ -0,0 +1,13 @@
+from s4py.package import ContentCache, DirPackage
+from s4py.resource import ResourceID
+
+R = ResourceID(0, 1, 0x1234)
+
+def test_dirpackage_replace(tmp_path):
+    pkg = DirPackage(str(tmp_path), mode="w")
+    pkg.content_cache = ContentCache()
+    pkg.put(R, b"old")
+    assert pkg[R].content == b"old"
+    pkg.put(R, b"new!")
+    assert pkg[R].content == b"new!"
+    assert pkg.content_cache.stats().size == 4
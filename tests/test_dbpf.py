@@ -0,0 +1,188 @@
+import io
+import os
+
+import pytest
+
+from s4py import utils
+from s4py.package import DbpfPackage, dbpf
+from s4py.resource import ResourceID
+
+A = ResourceID(0, 1, 1)
+B = ResourceID(0, 2, 1)
+C = ResourceID(0, 3, 1)
+
+def test_copy_from_unflushed_source(tmp_path):
+    src = str(tmp_path / "src.package")
+    dest = str(tmp_path / "dest.package")
+    pkg = DbpfPackage(src, "w")
+    pkg.put(A, b"A" * 100)
+    pkg.close()
+    pkg = DbpfPackage(src, "a")
+    pkg.put(B, b"B" * 100)
+    pkg.commit()
+    # Still sitting in the source's write buffer
+    pkg.put(C, b"C" * 100)
+    out = DbpfPackage(dest, "w")
+    out.copy_from(pkg, [C])
+    out.close()
+    pkg.close()
+    assert DbpfPackage(dest)[C].content == b"C" * 100
+
+def test_append_keeps_committed_index(tmp_path):
+    name = str(tmp_path / "a.package")
+    pkg = DbpfPackage(name, "w")
+    pkg.put(A, b"A" * 100)
+    pkg.close()
+    pkg = DbpfPackage(name, "a")
+    pkg.put(B, b"B" * 100)
+    pkg.commit()
+    pkg.put(C, b"C" * 100)
+    pkg._flush_pending()
+    pkg._writer.f.raw.flush()
+    # Without a second commit, the file still holds A and B
+    crashed = DbpfPackage(name)
+    assert crashed[A].content == b"A" * 100
+    assert crashed[B].content == b"B" * 100
+    assert C not in crashed
+    crashed.close()
+    pkg.close()
+    pkg = DbpfPackage(name)
+    assert [pkg[rid].content for rid in (A, B, C)] == \
+        [b"A" * 100, b"B" * 100, b"C" * 100]
+
+def test_compact_new_package(tmp_path):
+    name = str(tmp_path / "w.package")
+    pkg = DbpfPackage(name, "w", compression="none")
+    pkg.put(A, b"old" * 100)
+    pkg.commit()
+    pkg.put(A, b"A" * 100)
+    pkg.put(B, b"B" * 100)
+    pkg.remove(B)
+    assert pkg.compact() > 0
+    # Reopened in append mode
+    pkg.put(C, b"C" * 100)
+    pkg.close()
+    pkg = DbpfPackage(name)
+    assert sorted(pkg.scan_index()) == [A, C]
+    assert pkg[A].content == b"A" * 100
+    assert pkg[C].content == b"C" * 100
+
+def test_put_stream_store_if_larger(tmp_path):
+    name = str(tmp_path / "s.package")
+    noise = os.urandom(200000)
+    text = b"0123456789" * 20000
+    pkg = DbpfPackage(name, "w")
+    # Small enough to go through put()
+    pkg.put_stream(A, io.BytesIO(noise), len(noise))
+    # Unknown size, so streamed; neither stream can be rewound
+    pkg.put_stream(B, io.BufferedReader(io.BytesIO(noise)))
+    pkg.put_stream(C, io.BufferedReader(io.BytesIO(text)))
+    pkg.close()
+    pkg = DbpfPackage(name)
+    for rid in (A, B):
+        assert pkg[rid].locator.compression[0] == dbpf.COMPRESSION_NONE
+        assert pkg[rid].locator.raw_len == len(noise)
+        assert pkg[rid].content == noise
+    assert pkg[C].locator.compression[0] == dbpf.COMPRESSION_ZLIB
+    assert pkg[C].content == text
+
+def test_put_stream_store_if_larger_last(tmp_path):
+    # The compressed attempt is longer than the index that overwrites
+    # it, and must not be left at the end of the file
+    name = str(tmp_path / "s.package")
+    noise = os.urandom(200000)
+    for mode in ("w", "a"):
+        pkg = DbpfPackage(name, mode)
+        pkg.put_stream(B if mode == "a" else A,
+                       io.BufferedReader(io.BytesIO(noise)))
+        pkg.close()
+        pkg = DbpfPackage(name)
+        header = pkg.file.header
+        assert os.path.getsize(name) == header.index_pos + header.index_size
+        assert pkg[A].content == noise
+        pkg.close()
+
+def test_mmap_zero_copy(tmp_path):
+    name = str(tmp_path / "m.package")
+    pkg = DbpfPackage(name, "w", compression="none")
+    pkg.put(A, b"A" * 100)
+    pkg.close()
+    pkg = DbpfPackage(name, use_mmap=True)
+    content = pkg[A].content
+    assert isinstance(content, memoryview)
+    assert content.obj is pkg.file.view.obj
+    assert content == b"A" * 100
+    # The view outlives the package
+    pkg.close()
+    assert content == b"A" * 100
+    content.release()
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+@pytest.mark.parametrize("length", [0, 3, 50, 96, -10])
+def test_truncated_file(tmp_path, use_mmap, length):
+    name = str(tmp_path / "t.package")
+    pkg = DbpfPackage(name, "w", compression="none")
+    pkg.put(A, b"A" * 100)
+    pkg.close()
+    with open(name, "r+b") as f:
+        f.truncate(length if length >= 0 else os.path.getsize(name) + length)
+    with pytest.raises(utils.FormatException):
+        list(DbpfPackage(name, use_mmap=use_mmap).scan_index())
+
+def test_dedup_raw_and_content_apart(tmp_path):
+    name = str(tmp_path / "d.package")
+    pkg = DbpfPackage(name, "w", compression="none", dedup=True)
+    pkg.put_raw(A, b"abc", (dbpf.COMPRESSION_NONE, 1), 3)
+    # Hashes the same as the raw entry did before they were told apart
+    pkg.put(B, b"0:1:abc")
+    pkg.close()
+    pkg = DbpfPackage(name)
+    assert pkg[A].content == b"abc"
+    assert pkg[B].content == b"0:1:abc"
+
+def index_entries(name):
+    """(rid, compression type) for every entry in the on-disk index,
+    tombstones included"""
+    pkg = DbpfPackage(name)
+    columns = pkg.file.get_index_columns()
+    entries = [(ResourceID(group, instance, type), ctype)
+               for type, group, instance, ctype in zip(
+                       columns[0], columns[1], columns[2], columns[6])]
+    pkg.close()
+    return entries
+
+def test_tombstones(tmp_path):
+    name = str(tmp_path / "t.package")
+    pkg = DbpfPackage(name, "w")
+    pkg.put(A, b"A" * 100)
+    pkg.put(B, b"B" * 100)
+    pkg.put(C, b"C" * 100)
+    # No tombstones in a new package
+    pkg.remove(C)
+    pkg.close()
+    assert [rid for rid, _ in index_entries(name)] == [A, B]
+
+    pkg = DbpfPackage(name, "a")
+    pkg.remove(A)
+    pkg.remove(B)
+    pkg.put(B, b"b" * 100)
+    pkg.close()
+    assert index_entries(name) == [(A, dbpf.COMPRESSION_DELETED),
+                                   (B, dbpf.COMPRESSION_ZLIB)]
+    pkg = DbpfPackage(name)
+    assert list(pkg.scan_index()) == [B]
+    assert pkg[B].content == b"b" * 100
+
+def test_compact_read_only(tmp_path):
+    name = str(tmp_path / "r.package")
+    pkg = DbpfPackage(name, "w")
+    pkg.put(A, b"A" * 100)
+    pkg.close()
+    before = os.stat(name)
+    pkg = DbpfPackage(name)
+    with pytest.raises(TypeError):
+        pkg.compact()
+    pkg.close()
+    after = os.stat(name)
+    assert (after.st_ino, after.st_mtime_ns) == \
+        (before.st_ino, before.st_mtime_ns)
@@ -0,0 +1,48 @@
+from s4py.package import DbpfPackage, MetaPackage
+from s4py.resource import NotFilter, ResourceFilter, ResourceID, SetFilter, \
+    ValueSet, compile_filters
+from s4py.tools.package import parseFilter
+
+def make(tmp_path, name, rids):
+    path = str(tmp_path / name)
+    pkg = DbpfPackage(path, "w", compression="none")
+    for rid in rids:
+        pkg.put(rid, name.encode())
+    pkg.close()
+    return DbpfPackage(path)
+
+def test_lazy_scan(tmp_path):
+    base = make(tmp_path, "base.package",
+                [ResourceID(0, i, 1 + i % 2) for i in range(100)])
+    mods = [make(tmp_path, "mod%d.package" % m,
+                 [ResourceID(0, i, 1 + i % 2) for i in range(m, 120, 7)])
+            for m in range(3)]
+    lazy = MetaPackage([base] + mods, lazy=True)
+    eager = MetaPackage([base] + mods)
+    for filter in (None, ResourceFilter(type=2)):
+        rids = list(lazy.scan_index(filter))
+        assert len(rids) == len(set(rids))
+        assert set(rids) == set(eager.scan_index(filter))
+    for rid in lazy.scan_index():
+        assert lazy[rid].content == eager[rid].content
+
+def test_set_filter_scan(tmp_path):
+    pkg = make(tmp_path, "set.package",
+               [ResourceID(g, i, t) for g in (1, 2) for i in range(5)
+                for t in (1, 2, 3)])
+    found = list(pkg.scan_index(SetFilter(type=ValueSet((1, 3)))))
+    assert len(found) == 20
+    assert {rid.type for rid in found} == {1, 3}
+    found = list(pkg.scan_index(SetFilter(group=ValueSet(ranges=[(2, 5)]),
+                                          type=ValueSet((2,)))))
+    assert sorted(found) == [ResourceID(2, i, 2) for i in range(5)]
+
+def test_double_negation():
+    rid = ResourceID(1, 2, 3)
+    for filter in (parseFilter("!!1:2:3"), NotFilter(NotFilter(rid))):
+        compiled = compile_filters([filter])
+        assert compiled.match(rid)
+        assert not compiled.match(ResourceID(1, 2, 4))
+    compiled = compile_filters([NotFilter(NotFilter(NotFilter(rid)))])
+    assert not compiled.match(rid)
+    assert compiled.match(ResourceID(1, 2, 4))
@@ -0,0 +1,74 @@
+import random
+import time
+
+import pytest
+
+import simdatagen
+from s4py import simdata
+
+def linear_find(reader, pos, count):
+    """resolve_ref, done the way it was before the bisection index"""
+    for i, thdr in enumerate(reader.tableData):
+        if thdr.row_pos <= pos < thdr.row_pos + thdr.row_size * thdr.row_count:
+            row = (pos - thdr.row_pos) // thdr.row_size
+            if thdr.row_count < row + count:
+                raise simdata.FormatException("Object runs off end of table")
+            if row * thdr.row_size + thdr.row_pos != pos:
+                raise simdata.FormatException("Unaligned read of an object")
+            return i, slice(row, row + count)
+    raise simdata.FormatException("Object not in a table")
+
+def outcome(resolve, pos, count):
+    try:
+        return resolve(pos, count)
+    except simdata.FormatException as e:
+        return str(e)
+
+def test_resolve_ref_every_offset():
+    data = simdatagen.linked_tables(40, random.Random(1))
+    reader = simdata.SimDataReader(data, lazy=False)
+    assert reader._ref_starts is not None
+    for pos in range(len(data) + 8):
+        for count in (1, 2):
+            assert (outcome(reader.resolve_ref, pos, count) ==
+                    outcome(lambda p, c: linear_find(reader, p, c),
+                            pos, count))
+
+def test_overlapping_tables():
+    schemas = [(b'Node', 8, [(b'val', 7, 0), (b'next', 13, 4)])]
+    nodes = dict(name=None, schema=0, dtype=0, row_size=8,
+                 rows=[[(0, 'I', i), (4, 'ref', (1, 0))] for i in range(4)])
+    # Rows 1 and 2 of nodes, seen as a table of their own
+    middle = dict(name=None, schema=0, dtype=0, row_size=8,
+                  alias=(0, 1), row_count=2)
+    top = dict(name=b'Top', schema=0, dtype=0, row_size=8,
+               rows=[[(0, 'I', 99), (4, 'ref', (0, 2))]])
+    reader = simdata.SimDataReader(
+        simdatagen.build(schemas, [nodes, middle, top]))
+    # The index can't cope with overlap, so this takes the fallback,
+    # which picks the first table that contains the row
+    assert reader._ref_starts is None
+    assert reader.resolve_ref(reader.tableData[1].row_pos, 1) == \
+        (0, slice(1, 2))
+    assert [row['val'] for row in reader.tables[1]] == [1, 2]
+    assert reader.content['Top']['next']['val'] == 2
+    assert reader.tables[0][3]['next']['val'] == 1
+
+@pytest.mark.benchmark
+def test_benchmark(ntables=2000):
+    reader = simdata.SimDataReader(
+        simdatagen.linked_tables(ntables, random.Random(2)))
+    refs = [thdr.row_pos + k * thdr.row_size
+            for thdr in reader.tableData for k in range(thdr.row_count)]
+    start = time.perf_counter()
+    indexed = [reader.resolve_ref(pos, 1) for pos in refs]
+    bisected = time.perf_counter() - start
+    # Force the linear fallback
+    reader._ref_starts = None
+    start = time.perf_counter()
+    scanned = [reader.resolve_ref(pos, 1) for pos in refs]
+    linear = time.perf_counter() - start
+    print("%d tables, %d refs: bisection %.4fs, linear %.3fs"
+          % (ntables, len(refs), bisected, linear))
+    assert indexed == scanned
+    assert bisected < linear
@@ -0,0 +1,195 @@
+import random
+import struct
+import time
+
+import pytest
+
+import simdatagen
+from s4py import resource
+from s4py import simdata
+from s4py import utils
+
+def same(a, b):
+    """Whether a and b (rows, vectors, or plain values) are equal. Rows
+    are compared column by column, and a pair of rows that is already
+    being compared is taken to be equal, so that cycles end. Vectors
+    that know their element type must agree on it."""
+    pending = [(a, b)]
+    seen = set()
+    keep = []
+    while pending:
+        a, b = pending.pop()
+        if isinstance(a, utils.Thunk):
+            a = a.value
+        if isinstance(b, utils.Thunk):
+            b = b.value
+        schema = simdata._row_schema(a)
+        if schema is not None:
+            other = simdata._row_schema(b)
+            if other is None or schema.name != other.name:
+                return False
+            names = [column.name for column in schema.columns]
+            if names != [column.name for column in other.columns]:
+                return False
+            key = (simdata._row_identity(a), simdata._row_identity(b))
+            if key not in seen:
+                seen.add(key)
+                keep.append((a, b))
+                pending.extend((a[name], b[name]) for name in names)
+        elif isinstance(a, list):
+            if not isinstance(b, list) or len(a) != len(b):
+                return False
+            types = (getattr(a, 'data_type', None),
+                     getattr(b, 'data_type', None))
+            if (getattr(a, 'schema', None) is None and None not in types
+                    and types[0] != types[1]):
+                return False
+            pending.extend(zip(a, b))
+        elif a != b or type(a) != type(b):
+            return False
+    return True
+
+def same_content(a, b):
+    return a.keys() == b.keys() and all(same(a[name], b[name]) for name in a)
+
+def roundtrip(data, **kwargs):
+    """Read data, write it back, and check that what comes out reads
+    the same and is itself rewritten byte for byte. Returns the
+    written bytes."""
+    first = simdata.SimDataReader(data, **kwargs)
+    written = simdata.SimDataWriter(first.content).write()
+    second = simdata.SimDataReader(written, **kwargs)
+    assert second.errors == []
+    assert same_content(second.content, first.content)
+    assert simdata.SimDataWriter(second.content).write() == written
+    return written
+
+@pytest.mark.parametrize("nrows", [1, 5, 300])
+@pytest.mark.parametrize("nulls", [False, True])
+def test_every_type(nrows, nulls):
+    roundtrip(simdatagen.sample(nrows, random.Random(nrows), nulls))
+
+def test_columnar():
+    data = simdatagen.sample(200, random.Random(3))
+    written = roundtrip(data, columnar=True)
+    # Columnar and row-by-row reading agree, both ways round
+    assert same_content(
+        simdata.SimDataReader(written, columnar=True).content,
+        simdata.SimDataReader(data).content)
+    assert simdata.SimDataWriter(
+        simdata.SimDataReader(data).content).write() == written
+
+def test_schemaless_objects():
+    data = simdatagen.sample(20, random.Random(4))
+    top = simdata.SimDataReader(
+        simdata.SimDataWriter(
+            simdata.SimDataReader(data).content).write()).content['Top']
+    assert top['objs'].data_type == 13
+    assert top['objs'].schema is None
+    assert all(isinstance(obj, utils.Thunk) for obj in top['objs'])
+    assert [vector.data_type for vector in
+            (v.value for v in top['nested'])] == [7, 7]
+
+def test_linked_tables():
+    # Many unnamed tables, reached only through their references
+    reader = simdata.SimDataReader(
+        simdatagen.linked_tables(50, random.Random(5)))
+    content = {"t%d" % i: reader.tables[i][0]
+               for i in range(len(reader.tables))}
+    written = simdata.SimDataWriter(content).write()
+    assert same_content(simdata.SimDataReader(written).content, content)
+
+NODE = simdata.SimDataReader._Schema(b'Node', 0xabc, 52, (
+    simdata.SimDataReader._SchemaColumn('name', 11, 0, 0, None),
+    simdata.SimDataReader._SchemaColumn('weight', 10, 0, 4, None),
+    simdata.SimDataReader._SchemaColumn('parent', 13, 0, 8, None),
+    simdata.SimDataReader._SchemaColumn('shared', 13, 0, 12, None),
+    simdata.SimDataReader._SchemaColumn('tags', 14, 0, 16, None),
+    simdata.SimDataReader._SchemaColumn('ids', 14, 0, 24, None),
+    simdata.SimDataReader._SchemaColumn('kids', 14, 0, 32, None),
+    simdata.SimDataReader._SchemaColumn('flags', 14, 0, 40, None),
+    simdata.SimDataReader._SchemaColumn('enabled', 0, 0, 48, None),
+))
+
+def node(name, **values):
+    row = simdata.SimData(NODE)
+    row['name'] = name
+    row['weight'] = 0.0
+    row['enabled'] = False
+    for column in ('tags', 'ids', 'kids', 'flags'):
+        row[column] = []
+    for column, value in values.items():
+        row[column] = value
+    return row
+
+def test_handmade_graph():
+    shared = node('shared', weight=0.25, enabled=True)
+    root = node('root', weight=1.5, shared=shared, tags=['a', 'b', 'a'],
+                ids=[1, 2, 3], kids=[shared], flags=[True, False])
+    child = node('child', parent=root, shared=shared,
+                 ids=[resource.ResourceID(1, 2, 3)], tags=['a', 'b', 'a'])
+    # A cycle
+    root['parent'] = child
+    shared['parent'] = shared
+    content = {'Root': root, 'Child': child}
+    written = simdata.SimDataWriter(content).write()
+    reader = simdata.SimDataReader(written)
+    assert same_content(reader.content, content)
+    out = reader.content['Root']
+    # OBJECTs that point at the same row still do
+    assert out['shared'] is reader.content['Child']['shared']
+    assert out['shared']['parent'] is out['shared']
+    assert out['parent']['parent'] is out
+    assert out['tags'].data_type == 11
+    assert out['ids'].data_type == 6
+    assert out['flags'] == [True, False]
+    assert reader.content['Child']['ids'] == [resource.ResourceID(1, 2, 3)]
+    # Identical strings, and vectors of them, are only stored once
+    assert written.count(b'shared\0') == 1
+    assert [thdr.row_count for thdr in reader.tableData
+            if thdr.schema is None and thdr.data_type == 11] == [3]
+    roundtrip(written)
+
+def test_bool_bytes():
+    # A BOOL is true iff its byte is nonzero. Each row's tag sits just
+    # after its flag, to find the rows in the written bytes.
+    data = simdatagen.build(
+        [(b'Flag', 8, [(b'on', 0, 0), (b'tag', 7, 4)]),
+         (b'Top', 8, [(b'flags', 14, 0)])],
+        [dict(name=None, schema=0, dtype=0, row_size=8,
+              rows=[[(0, 'B', 1), (4, 'I', 0xdeadbeef)],
+                    [(0, 'B', 0), (4, 'I', 0xcafebabe)]]),
+         dict(name=b'Top', schema=1, dtype=0, row_size=8,
+              rows=[[(0, 'vec', (0, 0, 2))]])])
+    reader = simdata.SimDataReader(data)
+    assert [row['on'] for row in reader.content['Top']['flags']] == \
+        [True, False]
+    table = simdata.SimDataReader(data, columnar=True).tables[0]
+    assert isinstance(table, simdata.ColumnTable)
+    assert [row['on'] for row in table] == [True, False]
+    written = simdata.SimDataWriter(reader.content).write()
+    for tag, byte in ((0xdeadbeef, 1), (0xcafebabe, 0)):
+        assert written[written.index(struct.pack('<I', tag)) - 4] == byte
+
+def test_mixed_vector():
+    other = simdata.SimDataReader._Schema(b'Other', 0xdef, 4, (
+        simdata.SimDataReader._SchemaColumn('value', 7, 0, 0, None),))
+    stray = simdata.SimData(other, {'value': 1})
+    with pytest.raises(TypeError):
+        simdata.SimDataWriter({'Root': node('root', kids=[node('a'), stray])})
+
+@pytest.mark.benchmark
+def test_throughput():
+    reader = simdata.SimDataReader(simdatagen.sample(2000, random.Random(6)),
+                                   lazy=False)
+    start = time.perf_counter()
+    written = simdata.SimDataWriter(reader.content).write()
+    writing = time.perf_counter() - start
+    start = time.perf_counter()
+    simdata.SimDataReader(written, lazy=False)
+    reading = time.perf_counter() - start
+    print("SimData: wrote %d bytes in %.3fs (%.1f MB/s); read back in %.3fs"
+          % (len(written), writing, len(written) / writing / 1e6, reading))
+    # Writing has been about twice as slow as an eager read; allow
+    # plenty of slack for noisy machines
+    assert writing < 20 * reading